@@ -1,10 +1,28 @@
 import yaml
-from mastodon import Mastodon
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from mastodon import Mastodon, MastodonError, MastodonNetworkError
+from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.sqlite import SqliteSaver
 from src.mastodon.listener import BotStreamListener
+from src.mastodon.dispatcher import EventDispatcher
+from src.mastodon.accounts import AccountDirectory
+from src.mastodon.outbox import Outbox
+from src.mastodon.relevance import RelevanceFilter
+from src.mastodon.event_log import ProcessedIndex, catch_up
+from src.memory.retention import RetentionPolicy, CheckpointPruner, RetentionWorker, enable_incremental_vacuum
 from src.graph.logic_graph import build_graph
+from src.graph.rules import RuleEngine
+from src.graph.response_cache import ResponseCache
+from src.llm.replay import wrap_llm
+from src.metrics import registry as metrics
 from src.models.user_profile import UserProfile
+from typing import Any, Dict, List, Tuple
+import logging
 import os
+import threading
+import time
 
 
 def load_config(config_path: str) -> dict:
@@ -13,33 +31,140 @@ def load_config(config_path: str) -> dict:
         return yaml.safe_load(file)
 
 
+def agent_configs(config: dict) -> List[Dict[str, Any]]:
+    """Список агентов процесса: секция agents или единственный агент из user_profile и mastodon."""
+    if config.get('agents'):
+        return config['agents']
+
+    return [{'user_profile': config['user_profile'], 'mastodon': config['mastodon']}]
+
+
+def shared_clients(config: dict) -> Tuple[ChatOpenAI, requests.Session]:
+    """Общие для всех агентов клиент LLM и HTTP-сессия Mastodon с пулами соединений."""
+    pool_size = config['app'].get('http_pool_size', 20)
+
+    llm = ChatOpenAI(
+        **config['llm'],
+        http_client=httpx.Client(limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+    )
+    llm = wrap_llm(llm, config.get('llm_cache'))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return llm, session
+
+
+def stream_forever(mastodon: Mastodon, listener: BotStreamListener, processed: ProcessedIndex, reconnect_delay: float) -> None:
+    while True:
+        try:
+            # После старта и каждого обрыва стрима догружаем пропущенное
+            catch_up(mastodon, listener, processed)
+            mastodon.stream_user(listener)
+
+        except MastodonNetworkError as e:
+            logging.warning('Стрим прерван (%s), переподключение', e)
+            time.sleep(reconnect_delay)
+
+        # Ошибки API (5xx, лимиты, отказ в доступе) не должны останавливать поток агента
+        except MastodonError as e:
+            logging.error('Ошибка Mastodon при чтении стрима (%s), переподключение', e)
+            time.sleep(reconnect_delay)
+
+
 def main():
     config = load_config('config/config.yaml')
 
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
     for var, val in config['langsmith'].items():
         os.environ[var] = val
 
-    profile = UserProfile(
-        **config['user_profile']
-    )
+    # Метрики включаются до построения графов: обертки узлов создаются при сборке
+    metrics.configure(config.get('metrics'))
+
+    agents = agent_configs(config)
+    multi_agent = bool(config.get('agents'))
+
+    llm, session = shared_clients(config)
+    response_cache = ResponseCache.from_config(config.get('response_cache'))
 
-    mastodon = Mastodon(**config['mastodon'])
+    retention = RetentionPolicy.from_config(config['app'].get('retention'))
+
+    # Фоновая очистка возвращает место по частям, для этого режим задается до создания таблиц
+    enable_incremental_vacuum(config['app']['sqlite_path'])
 
     with SqliteSaver.from_conn_string(config['app']['sqlite_path']) as memory:
-        graph = build_graph(
-            profile=profile,
-            mastodon=mastodon,
-            checkpointer=memory,
-            llm_config=config['llm']
-        )
-        # from langchain_core.runnables.graph import CurveStyle, MermaidDrawMethod, NodeStyles
-        # from PIL import Image
-        # from io import BytesIO
-        #
-        # Image.open(BytesIO(graph.get_graph().draw_mermaid_png(draw_method=MermaidDrawMethod.API))).save('data/agent.png', 'PNG')
-
-        listener = BotStreamListener(graph, profile, mastodon)
-        mastodon.stream_user(listener)
+        if retention.keep_last or retention.max_idle_days:
+            RetentionWorker(CheckpointPruner(config['app']['sqlite_path'], retention)).start()
+
+        dispatcher = EventDispatcher(**config.get('dispatcher', {}))
+        dispatcher.start()
+
+        outboxes, streams = [], []
+
+        for agent in agents:
+            profile = UserProfile(
+                **agent['user_profile']
+            )
+
+            # Треды памяти и служебные таблицы разделяются по агенту, если агентов несколько
+            namespace = agent.get('name', profile.nick) if multi_agent else None
+
+            mastodon = Mastodon(**agent['mastodon'], session=session)
+
+            outbox = Outbox(mastodon, **config.get('outbox', {}))
+            outbox.start()
+            outboxes.append(outbox)
+
+            accounts = AccountDirectory(mastodon, config['app']['sqlite_path'], **config['app'].get('accounts', {}), namespace=namespace)
+
+            graph = build_graph(
+                profile=profile,
+                mastodon=outbox,
+                checkpointer=memory,
+                llm_config=config['llm'],
+                graph_config=config.get('graph'),
+                memory_config=config.get('memory'),
+                accounts=accounts,
+                llm=llm,
+                rules=RuleEngine.from_config(config.get('rules'), profile.interests),
+                response_cache=response_cache
+            )
+            # from langchain_core.runnables.graph import CurveStyle, MermaidDrawMethod, NodeStyles
+            # from PIL import Image
+            # from io import BytesIO
+            #
+            # Image.open(BytesIO(graph.get_graph().draw_mermaid_png(draw_method=MermaidDrawMethod.API))).save('data/agent.png', 'PNG')
+
+            relevance_config = dict(config.get('relevance', {}))
+            relevance = RelevanceFilter(profile.interests, **relevance_config) if relevance_config.pop('enabled', False) else None
+
+            processed = ProcessedIndex(config['app']['sqlite_path'], **config['app'].get('processed', {}), namespace=namespace)
+
+            listener = BotStreamListener(dispatcher, profile, mastodon, accounts=accounts, relevance=relevance, processed=processed,
+                                         graph=graph, namespace=namespace)
+
+            stream = threading.Thread(
+                target=stream_forever,
+                args=(mastodon, listener, processed, config['app'].get('reconnect_delay', 5)),
+                name=f'stream-{profile.nick}',
+                daemon=True
+            )
+            stream.start()
+            streams.append(stream)
+
+        try:
+            for stream in streams:
+                stream.join()
+
+        finally:
+            dispatcher.stop()
+
+            for outbox in outboxes:
+                outbox.stop()
 
 
 if __name__ == "__main__":
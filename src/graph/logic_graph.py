@@ -1,16 +1,27 @@
-from langchain.chains.question_answering.map_reduce_prompt import messages
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from pydantic import BaseModel, Field
-from typing import Dict, Any, Literal, Union, Annotated, List
+from typing import Dict, Any, Literal, Union, Annotated, List, Optional
 from typing_extensions import TypedDict
 from src.models.user_profile import UserProfile
+from src.memory.context_window import ContextWindow, TokenCounter, summary_prompt
+from src.memory.compact import encode_history, decode_history, drop_legacy_persona
+from src.mastodon.accounts import AccountDirectory
+from src.metrics import registry as metrics
+from src.graph.rules import ACTIONS, RuleEngine, restricted
+from src.graph.response_cache import ResponseCache
+from src.llm.replay import LLMCacheMiss
 from mastodon import Mastodon
+import logging
+from functools import wraps
 import random
 
 
+logger = logging.getLogger(__name__)
+
+
 class Decision(BaseModel):
     """Decision on what action to take"""
     action: Literal['post', 'reply', 'like', 'sub', 'unsub', 'pass'] = Field(description="""
@@ -23,24 +34,163 @@ pass - продолжить и ничего не делать
 """)
 
 
+class PlannedAction(BaseModel):
+    """Single action of the plan"""
+    action: Literal['post', 'reply', 'like', 'sub', 'unsub'] = Field(description="""
+post - написать новый пост у себя на странице
+reply - ответить на сообщение
+like - оценить сообщение
+sub - подписаться на пользователя
+unsub - отписаться от пользователя
+""")
+    content: Optional[str] = Field(default=None, description='Текст поста или ответа (только для post и reply)')
+
+
+class ActionPlan(BaseModel):
+    """Full plan of reactions to the input"""
+    actions: List[PlannedAction] = Field(description='Действия в порядке выполнения, каждое не более одного раза. Пустой список - ничего не делать')
+
+
+class LLMCallLimitExceeded(RuntimeError):
+    """Исчерпан лимит обращений к LLM на одно событие."""
+
+
+# Наибольшее число шагов графа на одно событие: analyze_context и apply_rules, затем пара
+# decide_action/make_action на каждое действие (повторы и pass не выполняются)
+# и завершающий decide_action; лимит обращений к LLM обычно останавливает граф раньше.
+# recursion_limit LangGraph должен быть больше числа шагов
+MAX_STEPS = 2 + 2 * (len(ACTIONS) - 1) + 1
+RECURSION_LIMIT = MAX_STEPS + 1
+
+
 # Состояние графа
 class AgentState(TypedDict):
-    profile: UserProfile
+    profile_id: str  # Ник агента; сам профиль не сохраняется в чекпоинтах, он задан при сборке графа
     context: Dict[str, Any]
     action: str
     content: str
-    chat_history: List[Dict[str, str]]
+    chat_history: List[List[str]]  # Пары [код роли, текст], см. src.memory.compact
+    summary: str
+    usage: Dict[str, int]
+    plan: List[Dict[str, Any]]
+    llm_calls: int
+    done_actions: List[str]
+    rule: Optional[str]
+    cached: Optional[Dict[str, Any]]
+
+
+def build_graph(profile: UserProfile, mastodon: Mastodon, checkpointer: Any, llm_config: Dict, graph_config: Dict = None, memory_config: Dict = None, accounts: AccountDirectory = None, llm: Any = None, rules: RuleEngine = None, response_cache: ResponseCache = None) -> StateGraph:
+    """Создает граф логики для управления поведением агента.
+
+    graph_config:
+        mode - 'steps' (решение и генерация текста отдельными вызовами LLM) или
+               'plan' (один структурированный вызов возвращает все действия с текстами)
+        max_llm_calls - лимит обращений к LLM на одно событие
+
+    memory_config:
+        token_budget - бюджет токенов окна истории, сверх него старые реплики сворачиваются в резюме
+        keep_ratio - доля бюджета, остающаяся в окне после сворачивания
+
+    accounts - справочник id аккаунтов; без него id ищется через API при каждой подписке/отписке
+    llm - готовый клиент LLM (например, общий для нескольких агентов); по умолчанию создается из llm_config
+    rules - правила, по которым действие выбирается без LLM или из суженного набора
+    response_cache - кэш реакций на короткие упоминания: для похожего сообщения повторяются
+                     прежние действия; текст ответа генерируется заново, а с rewrite - переписывается
+                     из сохраненного ответа (он мог быть написан другому пользователю)
+    """
+    graph_config = graph_config or {}
+    mode = graph_config.get('mode', 'steps')
+    max_llm_calls = graph_config.get('max_llm_calls', 4)
+
+    if llm is None:
+        llm = ChatOpenAI(**llm_config)
+
+    window = ContextWindow(TokenCounter(llm_config.get('model', 'gpt-4o-mini')), **(memory_config or {}))
+
+    # Префикс промпта не меняется между вызовами, чтобы срабатывало кэширование промптов на стороне провайдера
+    persona = f'Тебя зовут {profile.nick}, твои интересы: {profile.interests}, ты общаешься в стиле: {profile.style}. Не выбирай одно и то же действие 2 раза для реакции на один ввод от пользователя!'
+
+    # Ключ профиля в кэше реакций: при смене профиля старые ответы не используются
+    profile_key = f'{profile.nick}|{profile.style}|{",".join(profile.interests)}'
 
+    graph = StateGraph(AgentState)
 
-def build_graph(profile: UserProfile, mastodon: Mastodon, checkpointer: Any, llm_config: Dict) -> StateGraph:
-    """Создает граф логики для управления поведением агента."""
-    llm = ChatOpenAI(**llm_config)
+    def record_usage(state: AgentState, purpose: str, message: Any, estimate: int) -> None:
+        usage = getattr(message, 'usage_metadata', None) or {}
+        prompt_tokens = usage.get('input_tokens', estimate)
+        cached_tokens = usage.get('input_token_details', {}).get('cache_read', 0)
+        completion_tokens = usage.get('output_tokens', 0)
 
-    graph = StateGraph(AgentState)
+        state['usage']['prompt_tokens'] += prompt_tokens
+        state['usage']['completion_tokens'] += completion_tokens
+
+        metrics.inc('agent_llm_tokens_total', prompt_tokens, purpose=purpose, kind='prompt')
+        metrics.inc('agent_llm_tokens_total', completion_tokens, purpose=purpose, kind='completion')
+
+        logger.info('LLM (%s): промпт %d токенов (из кэша %d), ответ %d токенов', purpose, prompt_tokens, cached_tokens, completion_tokens)
+
+    def spend_llm_call(state: AgentState) -> None:
+        if state['llm_calls'] >= max_llm_calls:
+            raise LLMCallLimitExceeded(f'превышен лимит в {max_llm_calls} обращений к LLM')
+
+        state['llm_calls'] += 1
+
+    def call_llm(state: AgentState, instruction: str, schema: Any = None) -> Any:
+        spend_llm_call(state)
+
+        messages = window.messages(persona, state['summary'], state['chat_history'] + [{'role': 'system', 'content': instruction}])
+        estimate = window.counter.messages(messages)
+
+        if schema is not None:
+            with metrics.timer('agent_llm_seconds', purpose=schema.__name__):
+                result = llm.with_structured_output(schema, include_raw=True).invoke(messages)
+
+            record_usage(state, schema.__name__, result['raw'], estimate)
 
+            if result['parsing_error'] is not None:
+                raise result['parsing_error']
 
-    def create_post(history: List) -> str:
-        content = llm.invoke(history + [{'role': 'system', 'content': 'Ты решил написать пост, придумай текст для поста. В ответ выдавай только текст!'}]).content
+            return result['parsed']
+
+        with metrics.timer('agent_llm_seconds', purpose='text'):
+            response = llm.invoke(messages)
+
+        record_usage(state, 'text', response, estimate)
+
+        return response.content
+
+    def rewrite_reply(state: AgentState, reply: str) -> str:
+        # Без истории диалога: дешевый вызов, который заодно убирает из чужого ответа личные детали
+        messages = [
+            {'role': 'system', 'content': persona},
+            {'role': 'user', 'content': 'Перефразируй своими словами, сохранив смысл и стиль. Этот ответ был написан другому '
+                                        'собеседнику: убери обращения по имени и отсылки к прежней переписке. '
+                                        f'В ответ выдавай только текст!\n{reply}'},
+        ]
+        spend_llm_call(state)
+
+        with metrics.timer('agent_llm_seconds', purpose='rewrite'):
+            response = llm.invoke(messages)
+
+        record_usage(state, 'rewrite', response, window.counter.messages(messages))
+
+        return response.content
+
+    def summarize(state: AgentState, summary: str, folded: List[Dict[str, str]]) -> str:
+        messages = summary_prompt(summary, folded)
+        # Сворачивание истории - такое же обращение к LLM и расходует лимит события
+        spend_llm_call(state)
+
+        with metrics.timer('agent_llm_seconds', purpose='summary'):
+            response = llm.invoke(messages)
+
+        record_usage(state, 'summary', response, window.counter.messages(messages))
+
+        return response.content
+
+    def create_post(state: AgentState, content: str = None) -> str:
+        if content is None:
+            content = call_llm(state, 'Ты решил написать пост, придумай текст для поста. В ответ выдавай только текст!')
 
         mastodon.status_post(content)
 
@@ -52,25 +202,34 @@ def build_graph(profile: UserProfile, mastodon: Mastodon, checkpointer: Any, llm
 
         return
 
-    def reply_to_post(post_id: int, history: List) -> str:
-        reply = llm.invoke(history + [{'role': 'system', 'content': 'Ты решил написать ответ пользователю'}]).content
+    def reply_to_post(state: AgentState, post_id: int, reply: str = None) -> str:
+        cached = state.get('cached') or {}
+
+        # Сохраненный ответ адресован другому пользователю и дословно не отправляется
+        if reply is None and cached.get('reply') and response_cache.rewrite:
+            reply = rewrite_reply(state, cached['reply'])
+
+        if reply is None:
+            reply = call_llm(state, 'Ты решил написать ответ пользователю')
 
         mastodon.status_post(reply, in_reply_to_id=post_id)
 
         return reply
 
-    def sub_to_user(nick: str) -> None:
-        results = mastodon.account_search(nick, limit=1)
+    def resolve_account(nick: str) -> Any:
+        if accounts is not None:
+            return accounts.resolve(nick)
+
+        return mastodon.account_search(nick, limit=1)[0]['id']
 
-        user_id = results[0]['id']
+    def sub_to_user(nick: str) -> None:
+        user_id = resolve_account(nick)
         mastodon.account_follow(user_id)
 
         return
 
     def unsub_from_user(nick: str) -> None:
-        results = mastodon.account_search(nick, limit=1)
-
-        user_id = results[0]['id']
+        user_id = resolve_account(nick)
         mastodon.account_unfollow(user_id)
 
         return
@@ -78,56 +237,201 @@ def build_graph(profile: UserProfile, mastodon: Mastodon, checkpointer: Any, llm
     def analyze_context(state: AgentState) -> AgentState:
         context = state.get('context', {})
 
+        # Счетчики действуют в пределах одного события
+        state['plan'] = []
+        state['llm_calls'] = 0
+        state['done_actions'] = []
+        state['usage'] = {'prompt_tokens': 0, 'completion_tokens': 0}
+        state['cached'] = None
+
         if not state.get('chat_history'):
-            state['chat_history'] = [{
-                'role': 'system',
-                'content': f'Тебя зовут {profile.nick}, твои интересы: {profile.interests}, ты общаешься в стиле: {profile.style}. Не выбирай одно и то же действие 2 раза для реакции на один ввод от пользователя!'
-            }]
-
-        if len(state['chat_history']) >= 8:
-            state['chat_history'] = [{
-                'role': 'system',
-                'content': f'Тебя зовут {profile.nick}, твои интересы: {profile.interests}, ты общаешься в стиле: {profile.style}'
-            }] + state['chat_history'][len(state['chat_history'])-8:]
-
-        if state['context']['is_mention']:
+            state['chat_history'] = []
+
+        if not state.get('summary'):
+            state['summary'] = ''
+
+        # Персона больше не хранится в истории: в старых чекпоинтах она идет первым сообщением
+        state['chat_history'] = drop_legacy_persona(state['chat_history'])
+
+        if context.get('batch'):
+            lines = [
+                f'{n}. {"сообщение тебе" if item["is_mention"] else "пост"}: {item["text"]}'
+                for n, item in enumerate(context['batch'], start=1)
+            ]
+            state['chat_history'].append({'role': 'user', 'content': f'Пользователь {context.get("user")} написал несколько сообщений подряд:\n' + '\n'.join(lines)})
+
+        elif state['context']['is_mention']:
             state['chat_history'].append({'role': 'user', 'content': f'Пользователь {context.get("user")} написал тебе сообщение: {context.get("text")}'})
 
         else:
             state['chat_history'].append({'role': 'user',
                                        'content': f'Пользователь {context.get("user")} написал пост: {context.get("text")}'})
 
+        try:
+            state['chat_history'], state['summary'] = window.fit(
+                state['chat_history'],
+                state['summary'],
+                lambda summary, folded: summarize(state, summary, folded)
+            )
+
+        except LLMCallLimitExceeded:
+            # Без обращений к LLM окно остается несвернутым до следующего события
+            logger.info('Сворачивание истории пропущено: исчерпан лимит в %d обращений к LLM', max_llm_calls)
+
+        return state
+
+    def compact(node: Any) -> Any:
+        # Внутри узла история - список сообщений-словарей, в чекпоинт уходит компактная запись
+        @wraps(node)
+        def wrapper(state: AgentState) -> AgentState:
+            state['chat_history'] = decode_history(state.get('chat_history') or [])
+            state = node(state)
+            state['chat_history'] = encode_history(state['chat_history'])
+
+            return state
+
+        return wrapper
+
+    def apply_rules(state: AgentState) -> AgentState:
+        rule = rules.match(state['context']) if rules is not None else None
+        state['rule'] = rule.name if rule else None
+
+        if rule:
+            logger.info('Сработало правило %s для события пользователя %s', rule.name, state['context'].get('user'))
+
+        return state
+
+    def cacheable(context: Dict[str, Any]) -> bool:
+        # Кэшируются только одиночные упоминания: ответ на пачку зависит от всех сообщений
+        return response_cache is not None and context.get('is_mention') and not context.get('batch') and response_cache.cacheable(context.get('text', ''))
+
+    def remember_response(state: AgentState, reply: str = None) -> None:
+        # При исчерпанном лимите часть действий могла быть пропущена - такую реакцию не запоминаем
+        if cacheable(state['context']) and state.get('cached') is None and state['llm_calls'] < max_llm_calls:
+            response_cache.store(profile_key, state['context']['text'], state['done_actions'], reply)
+
+    def decide_by_rule(state: AgentState, actions: List[str]) -> AgentState:
+        actions = [a for a in actions if a != 'pass' and a not in state['done_actions']]
+
+        if mode == 'plan':
+            # Тексты поста и ответа сгенерируются при выполнении действий
+            state['plan'] = [{'action': a, 'content': None} for a in actions]
+            state['action'] = 'plan' if actions else 'pass'
+
+        else:
+            state['action'] = actions[0] if actions else 'pass'
+
         return state
 
     def decide_action(state: AgentState) -> AgentState:
-        # Вероятности действий
+        if state['llm_calls'] >= max_llm_calls:
+            state['action'] = 'pass'
+
+            return state
+
+        rule = rules.by_name.get(state.get('rule')) if rules is not None else None
+        allowed = rule.allow if rule else None
+
+        # Кэш проверяется до правил: ответ, выбранный правилом, тоже может быть переписан из кэша
+        if state.get('cached') is None and not state['done_actions'] and cacheable(state['context']):
+            entry = response_cache.lookup(profile_key, state['context']['text'])
+
+            if entry is not None:
+                state['cached'] = {'actions': entry.actions, 'reply': entry.reply}
+
+        if rule and rule.actions is not None:
+            return decide_by_rule(state, rule.actions)
+
+        if allowed is not None and not set(allowed) - {'pass'}:
+            return decide_by_rule(state, [])
+
+        if state.get('cached') is not None:
+            return decide_by_rule(state, [a for a in state['cached']['actions'] if allowed is None or a in allowed])
+
+        if mode == 'plan':
+            schema = restricted(ActionPlan, allowed) if allowed else ActionPlan
+            result = call_llm(state, 'Составь план реакции: перечисли действия и сразу напиши тексты для поста или ответа', schema=schema)
+
+            plan, seen = [], set(state['done_actions'])
+            for step in result.actions:
+                if step.action not in seen:
+                    seen.add(step.action)
+                    plan.append(step.model_dump())
+
+            state['plan'] = plan
+            state['action'] = 'plan' if plan else 'pass'
 
-        messages = state['chat_history'] + [{'role': 'system', 'content': 'Прими решение, что делать дальше'}]
+            return state
 
-        result = llm.with_structured_output(Decision).invoke(messages)
+        result = call_llm(state, 'Прими решение, что делать дальше', schema=restricted(Decision, allowed) if allowed else Decision)
 
-        state['action'] = result.action
+        # Одно и то же действие не выполняется дважды в ответ на один ввод
+        state['action'] = 'pass' if result.action in state['done_actions'] else result.action
 
         return state
 
     def make_action(state: AgentState) -> AgentState:
-        action = state['action']
+        if state['action'] == 'plan':
+            for step in state['plan']:
+                execute(state, step['action'], step.get('content'))
+
+        else:
+            execute(state, state['action'])
+
+        remember_response(state)
+
+        return state
+
+    def skip_over_limit(state: AgentState, action: str) -> None:
+        # Текст не сгенерирован из-за лимита: действие не выполнено, и в историю это не пишется,
+        # иначе сообщение о лимите попадало бы в промпт каждого следующего события
+        state['done_actions'].remove(action)
+        logger.info('Действие %s пропущено: исчерпан лимит в %d обращений к LLM', action, max_llm_calls)
+
+    def execute(state: AgentState, action: str, content: str = None) -> None:
+        if action in state['done_actions']:
+            return
+
+        state['done_actions'].append(action)
 
         if action == 'post':
             try:
-                content = create_post(history=state['chat_history'])
+                content = create_post(state, content=content)
                 state['content'] = content
                 state['chat_history'].append({'role': 'system', 'content': f'Ты написал пост у себя на странице: {content}'})
 
+            # Промах кэша LLM в режиме replay (пост и ответ пишет LLM) - ошибка прогона, а не неудачное действие
+            except LLMCacheMiss:
+                raise
+
+            except LLMCallLimitExceeded:
+                skip_over_limit(state, action)
+
             except Exception as e:
                 state['chat_history'].append({'role': 'system', 'content': f'У тебя не получилось написать пост у себя на странице по причине: {e}'})
 
         if action == 'reply':
             try:
-                content = reply_to_post(post_id=state['context'].get('post_id'), history=state['chat_history'])
+                content = reply_to_post(state, post_id=state['context'].get('post_id'), reply=content)
                 state['content'] = content
+                remember_response(state, reply=content)
                 state['chat_history'].append({'role': 'system', 'content': f'Ты ответил пользователю: {content}'})
 
+                # В пачке сообщений отвечаем на последнее, остальные отмечаем лайком
+                others = [item['post_id'] for item in state['context'].get('batch', []) if item['post_id'] != state['context'].get('post_id')]
+                if others and 'like' not in state['done_actions']:
+                    state['done_actions'].append('like')
+                    for post_id in others:
+                        like_post(post_id=post_id)
+
+                    state['chat_history'].append({'role': 'system', 'content': 'Ты поставил лайк остальным сообщениям пользователя'})
+
+            except LLMCacheMiss:
+                raise
+
+            except LLMCallLimitExceeded:
+                skip_over_limit(state, action)
+
             except Exception as e:
                 import traceback
                 print(traceback.format_exc())
@@ -136,9 +440,11 @@ def build_graph(profile: UserProfile, mastodon: Mastodon, checkpointer: Any, llm
 
         if action == 'like':
             try:
-                like_post(post_id=state['context'].get('post_id'))
+                for post_id in [item['post_id'] for item in state['context'].get('batch', [])] or [state['context'].get('post_id')]:
+                    like_post(post_id=post_id)
+
                 state['content'] = None
-                state['chat_history'].append({'role': 'system', 'content': 'Ты поставил лайк последнему посту пользователя'})
+                state['chat_history'].append({'role': 'system', 'content': 'Ты поставил лайк сообщениям пользователя' if state['context'].get('batch') else 'Ты поставил лайк последнему посту пользователя'})
 
             except Exception as e:
                 state['chat_history'].append({'role': 'system',
@@ -146,7 +452,8 @@ def build_graph(profile: UserProfile, mastodon: Mastodon, checkpointer: Any, llm
 
         if action == 'sub':
             try:
-                sub_to_user(nick=state['context'].get('user'))
+                # acct (ник@сервер) однозначен и для федеративных аккаунтов
+                sub_to_user(nick=state['context'].get('acct') or state['context'].get('user'))
                 state['content'] = None
                 state['chat_history'].append({'role': 'system', 'content': 'Ты подписался на пользователя'})
 
@@ -156,7 +463,8 @@ def build_graph(profile: UserProfile, mastodon: Mastodon, checkpointer: Any, llm
 
         if action == 'unsub':
             try:
-                unsub_from_user(nick=state['context'].get('user'))
+                # acct (ник@сервер) однозначен и для федеративных аккаунтов
+                unsub_from_user(nick=state['context'].get('acct') or state['context'].get('user'))
                 state['content'] = None
                 state['chat_history'].append({'role': 'system', 'content': 'Ты отписался от пользователя'})
 
@@ -164,7 +472,8 @@ def build_graph(profile: UserProfile, mastodon: Mastodon, checkpointer: Any, llm
                 state['chat_history'].append({'role': 'system',
                                            'content': f'У тебя не получилось отписаться от пользователя по причине: {e}'})
 
-        return state
+        if action in state['done_actions']:
+            metrics.inc('agent_actions_total', action=action)
 
     def route_by_status(state: AgentState) -> Literal["make_action", "end"]:
         if state['action'] != 'pass':
@@ -173,15 +482,32 @@ def build_graph(profile: UserProfile, mastodon: Mastodon, checkpointer: Any, llm
         else:
             return "end"
 
+    def route_after_action(state: AgentState) -> Literal["decide_action", "end"]:
+        # В режиме плана все действия уже выполнены, повторное решение не нужно
+        if mode == 'plan':
+            return "end"
+
+        return "decide_action"
+
     # Определение узлов
-    graph.add_node("analyze_context", analyze_context)
-    graph.add_node("decide_action", decide_action)
-    graph.add_node("make_action", make_action)
+    graph.add_node("analyze_context", metrics.timed('agent_node_seconds', node='analyze_context')(compact(analyze_context)))
+    graph.add_node("apply_rules", metrics.timed('agent_node_seconds', node='apply_rules')(apply_rules))
+    graph.add_node("decide_action", metrics.timed('agent_node_seconds', node='decide_action')(compact(decide_action)))
+    graph.add_node("make_action", metrics.timed('agent_node_seconds', node='make_action')(compact(make_action)))
 
     # Определение ребер
     graph.set_entry_point("analyze_context")
-    graph.add_edge("analyze_context", "decide_action")
-    graph.add_edge("make_action", "decide_action")
+    graph.add_edge("analyze_context", "apply_rules")
+    graph.add_edge("apply_rules", "decide_action")
+
+    graph.add_conditional_edges(
+        "make_action",
+        route_after_action,
+        {
+            "decide_action": "decide_action",
+            "end": END
+        }
+    )
 
     graph.add_conditional_edges(
         "decide_action",
@@ -192,4 +518,4 @@ def build_graph(profile: UserProfile, mastodon: Mastodon, checkpointer: Any, llm
         }
     )
 
-    return graph.compile(checkpointer=checkpointer)
\ No newline at end of file
+    return graph.compile(checkpointer=checkpointer).with_config(recursion_limit=RECURSION_LIMIT)
\ No newline at end of file
@@ -0,0 +1,159 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+from src.metrics import registry as metrics
+
+
+MENTION_RE = re.compile(r'@[\w.@-]+')
+URL_RE = re.compile(r'https?://\S+')
+NON_WORD_RE = re.compile(r'[^\w\s]+')
+SPACE_RE = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    """Текст без упоминаний, ссылок, пунктуации и регистра."""
+    text = URL_RE.sub(' ', MENTION_RE.sub(' ', text.lower().replace('ё', 'е')))
+
+    return SPACE_RE.sub(' ', NON_WORD_RE.sub(' ', text)).strip()
+
+
+def trigrams(text: str) -> FrozenSet[str]:
+    padded = f'  {text} '
+
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def similarity(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    """Коэффициент Жаккара по символьным триграммам."""
+    if not a or not b:
+        return 0.0
+
+    return len(a & b) / len(a | b)
+
+
+@dataclass
+class CachedResponse:
+    text: str
+    grams: FrozenSet[str]
+    actions: List[str]
+    reply: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+
+
+class ResponseCache:
+    """Кэш реакций агента на короткие входящие сообщения.
+
+    Ключ - профиль агента и нормализованный текст. Если точного совпадения нет,
+    ищется самый похожий текст того же профиля с похожестью не ниже threshold.
+    Размер ограничен capacity (вытесняются давно не использованные), записи
+    старше ttl_hours не выдаются. Сообщения длиннее max_length не кэшируются.
+    Повторяются только действия; сохраненный ответ используется лишь с rewrite,
+    как основа для переписанного текста - он мог быть написан другому пользователю.
+    """
+
+    def __init__(self, capacity: int = 500, ttl_hours: float = 24, threshold: float = 0.85, max_length: int = 80, rewrite: bool = False):
+        self.capacity = capacity
+        self.ttl = ttl_hours * 3600
+        self.threshold = threshold
+        self.max_length = max_length
+        self.rewrite = rewrite
+
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+
+        self._entries: 'OrderedDict[Tuple[str, str], CachedResponse]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any] = None) -> Optional['ResponseCache']:
+        """Создает кэш по секции response_cache конфигурации; None, если кэш выключен."""
+        config = dict(config or {})
+
+        if not config.pop('enabled', False):
+            return None
+
+        return cls(**config)
+
+    def cacheable(self, text: str) -> bool:
+        return 0 < len(normalize_text(text)) <= self.max_length
+
+    def _fresh(self, entry: CachedResponse) -> bool:
+        return time.time() - entry.created_at < self.ttl
+
+    def lookup(self, profile: str, text: str) -> Optional[CachedResponse]:
+        text = normalize_text(text)
+        key = (profile, text)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            result = 'exact'
+
+            if entry is not None and not self._fresh(entry):
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+
+            if entry is None:
+                grams, best, result = trigrams(text), 0.0, 'similar'
+
+                for (entry_profile, _), candidate in self._entries.items():
+                    if entry_profile == profile and self._fresh(candidate):
+                        score = similarity(grams, candidate.grams)
+
+                        if score >= self.threshold and score > best:
+                            entry, best = candidate, score
+
+            if entry is None:
+                self.misses += 1
+                result = 'miss'
+
+            else:
+                self._entries.move_to_end((profile, entry.text))
+
+                if result == 'exact':
+                    self.exact_hits += 1
+                else:
+                    self.similar_hits += 1
+
+        metrics.inc('agent_response_cache_total', result=result)
+
+        return entry
+
+    def store(self, profile: str, text: str, actions: List[str], reply: str = None) -> None:
+        """Запоминает реакцию; без reply сохраняется ранее записанный ответ на этот текст."""
+        text = normalize_text(text)
+        key = (profile, text)
+
+        with self._lock:
+            previous = self._entries.get(key)
+
+            if reply is None and previous is not None:
+                reply = previous.reply
+
+            self._entries[key] = CachedResponse(text=text, grams=trigrams(text), actions=list(actions), reply=reply)
+            self._entries.move_to_end(key)
+
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.exact_hits + self.similar_hits
+            total = hits + self.misses
+
+            return {
+                'size': len(self._entries),
+                'exact_hits': self.exact_hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+                'hit_rate': round(hits / total, 3) if total else 0.0,
+                'evicted': self.evicted,
+                'expired': self.expired,
+            }
@@ -0,0 +1,134 @@
+import logging
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Literal, Optional, Tuple
+from pydantic import Field, create_model
+from src.mastodon.relevance import RelevanceFilter
+from src.metrics import registry as metrics
+
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ('post', 'reply', 'like', 'sub', 'unsub', 'pass')
+
+
+@dataclass
+class Rule:
+    """Правило быстрого решения без обращения к LLM.
+
+    Условия (все заданные должны выполниться):
+        is_mention - событие является упоминанием агента (или нет)
+        users - ник автора входит в список
+        pattern - регулярное выражение, найденное в тексте (без учета регистра)
+        interests - текст совпадает (true) или не совпадает (false) с интересами агента
+
+    Результат:
+        actions - действия по порядку, LLM не вызывается; пустой список - ничего не делать
+        allow - LLM выбирает только из перечисленных действий
+    """
+    name: str
+    is_mention: Optional[bool] = None
+    users: Optional[List[str]] = None
+    pattern: Optional[str] = None
+    interests: Optional[bool] = None
+    actions: Optional[List[str]] = None
+    allow: Optional[List[str]] = None
+    regex: Any = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if (self.actions is None) == (self.allow is None):
+            raise ValueError(f'Правило {self.name}: нужно задать ровно одно из actions и allow')
+
+        unknown = set(self.allow if self.actions is None else self.actions) - set(ACTIONS)
+        if unknown:
+            raise ValueError(f'Правило {self.name}: неизвестные действия {sorted(unknown)}')
+
+        self.regex = re.compile(self.pattern, re.IGNORECASE) if self.pattern else None
+
+
+class RuleEngine:
+    """Подбирает для события первое подходящее правило и считает попадания."""
+
+    def __init__(self, rules: List[Rule], interests: List[str] = None, interest_threshold: float = 0.5):
+        self.rules = rules
+        self.by_name = {rule.name: rule for rule in rules}
+        self.relevance = RelevanceFilter(interests or [], threshold=interest_threshold)
+
+        self.events = 0
+        self.hits: Dict[str, int] = {rule.name: 0 for rule in rules}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any] = None, interests: List[str] = None) -> Optional['RuleEngine']:
+        """Создает движок по секции rules конфигурации; None, если правил нет или они выключены (enabled: false)."""
+        config = config or {}
+
+        if not config.get('enabled', True) or not config.get('items'):
+            return None
+
+        return cls([Rule(**rule) for rule in config['items']], interests, config.get('interest_threshold', 0.5))
+
+    def matches(self, rule: Rule, context: Dict[str, Any]) -> bool:
+        text = context.get('text', '')
+
+        if rule.is_mention is not None and bool(context.get('is_mention')) != rule.is_mention:
+            return False
+
+        if rule.users is not None and context.get('user') not in rule.users:
+            return False
+
+        if rule.regex is not None and not rule.regex.search(text):
+            return False
+
+        if rule.interests is not None and (self.relevance.score(text) >= self.relevance.threshold) != rule.interests:
+            return False
+
+        return True
+
+    def match(self, context: Dict[str, Any]) -> Optional[Rule]:
+        rule = next((rule for rule in self.rules if self.matches(rule, context)), None)
+
+        with self._lock:
+            self.events += 1
+
+            if rule is not None:
+                self.hits[rule.name] += 1
+
+        metrics.inc('agent_rule_hits_total', rule=rule.name if rule else 'none')
+
+        return rule
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = sum(self.hits.values())
+            decided = sum(n for name, n in self.hits.items() if self.by_name[name].actions is not None)
+
+            return {
+                'events': self.events,
+                'hits': dict(self.hits),
+                'hit_rate': round(hits / self.events, 3) if self.events else 0.0,
+                'decided_without_llm': decided,
+                'narrowed': hits - decided,
+            }
+
+
+_schemas: Dict[Tuple[str, Tuple[str, ...]], Any] = {}
+
+
+def restricted(schema: Any, allowed: List[str]) -> Any:
+    """Копия схемы Decision или ActionPlan, в которой поле action принимает только allowed."""
+    key = (schema.__name__, tuple(allowed))
+
+    if key not in _schemas:
+        if 'actions' in schema.model_fields:
+            # План: сужается действие каждого шага, pass в плане не используется
+            info = schema.model_fields['actions']
+            step = restricted(info.annotation.__args__[0], [a for a in allowed if a != 'pass'])
+            _schemas[key] = create_model(schema.__name__, __base__=schema, actions=(List[step], Field(description=info.description)))
+
+        else:
+            info = schema.model_fields['action']
+            _schemas[key] = create_model(schema.__name__, __base__=schema, action=(Literal[tuple(allowed)], Field(description=info.description)))
+
+    return _schemas[key]
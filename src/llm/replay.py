@@ -0,0 +1,185 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import textwrap
+import threading
+from typing import Any, Dict, List, Optional
+from langchain_core.messages import AIMessage, BaseMessage
+
+
+logger = logging.getLogger(__name__)
+
+MODES = ('off', 'record', 'replay')
+MISS_POLICIES = ('fail', 'passthrough')
+
+
+class LLMCacheMiss(RuntimeError):
+    """В режиме replay для запроса нет сохраненного ответа."""
+
+
+def normalize_messages(messages: Any) -> List[Dict[str, str]]:
+    """Приводит промпт (строка, словари или сообщения LangChain) к единому виду."""
+    if isinstance(messages, str):
+        return [{'role': 'user', 'content': textwrap.dedent(messages).strip()}]
+
+    normalized = []
+    for message in messages:
+        if isinstance(message, BaseMessage):
+            normalized.append({'role': message.type, 'content': message.content})
+        else:
+            normalized.append({'role': message['role'], 'content': message['content']})
+
+    return normalized
+
+
+def cache_key(messages: Any, model: str, schema: Any = None) -> str:
+    payload = {
+        'model': model,
+        'messages': normalize_messages(messages),
+        'schema': schema.model_json_schema() if schema is not None else None,
+    }
+
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def dump_message(message: AIMessage) -> Dict[str, Any]:
+    return {'content': message.content, 'usage_metadata': message.usage_metadata}
+
+
+def load_message(payload: Dict[str, Any]) -> AIMessage:
+    return AIMessage(content=payload['content'], usage_metadata=payload['usage_metadata'])
+
+
+class ResponseStore:
+    """Локальное хранилище ответов LLM в SQLite."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS llm_responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)')
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM llm_responses WHERE key = ?', (key,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, response: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO llm_responses (key, response) VALUES (?, ?)', (key, json.dumps(response, ensure_ascii=False)))
+            self._conn.commit()
+
+
+class CachedChatModel:
+    """Обертка над ChatOpenAI с записью и воспроизведением ответов.
+
+    record - каждый запрос уходит в LLM, ответ сохраняется по хэшу нормализованных
+    сообщений, модели и схемы структурированного вывода;
+    replay - ответы берутся из хранилища без обращения к сети, при промахе
+    on_miss='fail' выбрасывает LLMCacheMiss, on_miss='passthrough' идет в LLM и сохраняет ответ.
+    """
+
+    def __init__(self, llm: Any, store: ResponseStore, mode: str = 'replay', on_miss: str = 'fail'):
+        if mode not in MODES[1:]:
+            raise ValueError(f'Неизвестный режим кэша LLM: {mode}')
+
+        if on_miss not in MISS_POLICIES:
+            raise ValueError(f'Неизвестная политика промаха: {on_miss}')
+
+        self.llm = llm
+        self.store = store
+        self.mode = mode
+        self.on_miss = on_miss
+        self.model = getattr(llm, 'model_name', None) or getattr(llm, 'model', '')
+
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return getattr(self.llm, name)
+
+    def _cached(self, key: str, call: Any) -> Dict[str, Any]:
+        if self.mode == 'replay':
+            response = self.store.get(key)
+
+            with self._lock:
+                if response is not None:
+                    self.hits += 1
+                    return response
+
+                self.misses += 1
+
+            if self.on_miss == 'fail':
+                raise LLMCacheMiss(f'нет сохраненного ответа для запроса {key[:12]}')
+
+            logger.warning('Промах кэша LLM %s, запрос уходит в модель', key[:12])
+
+        response = call()
+        self.store.put(key, response)
+
+        with self._lock:
+            self.recorded += 1
+
+        return response
+
+    def invoke(self, messages: Any, *args, **kwargs) -> AIMessage:
+        response = self._cached(cache_key(messages, self.model), lambda: dump_message(self.llm.invoke(messages, *args, **kwargs)))
+
+        return load_message(response)
+
+    def with_structured_output(self, schema: Any, include_raw: bool = False, **kwargs) -> 'CachedStructuredOutput':
+        return CachedStructuredOutput(self, schema, include_raw, kwargs)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'recorded': self.recorded}
+
+
+class CachedStructuredOutput:
+    def __init__(self, parent: CachedChatModel, schema: Any, include_raw: bool, kwargs: Dict[str, Any]):
+        self.parent = parent
+        self.schema = schema
+        self.include_raw = include_raw
+        self.kwargs = kwargs
+
+    def _call(self, messages: Any) -> Dict[str, Any]:
+        result = self.parent.llm.with_structured_output(self.schema, include_raw=True, **self.kwargs).invoke(messages)
+
+        if result['parsing_error'] is not None:
+            raise result['parsing_error']
+
+        return {'parsed': result['parsed'].model_dump(), 'raw': dump_message(result['raw'])}
+
+    def invoke(self, messages: Any, *args, **kwargs) -> Any:
+        key = cache_key(messages, self.parent.model, self.schema)
+        response = self.parent._cached(key, lambda: self._call(messages))
+        parsed = self.schema.model_validate(response['parsed'])
+
+        if self.include_raw:
+            return {'raw': load_message(response['raw']), 'parsed': parsed, 'parsing_error': None}
+
+        return parsed
+
+
+def wrap_llm(llm: Any, cache_config: Dict[str, Any] = None, store: ResponseStore = None) -> Any:
+    """Оборачивает клиент LLM в кэш согласно секции llm_cache конфигурации.
+
+    Несколько клиентов (агент и судья) могут писать в одно хранилище store.
+    """
+    cache_config = dict(cache_config or {})
+    mode = cache_config.pop('mode', 'off')
+    path = cache_config.pop('path', 'data/llm_cache.sqlite')
+
+    if mode == 'off':
+        return llm
+
+    store = store or ResponseStore(path)
+
+    return CachedChatModel(llm, store, mode=mode, **cache_config)
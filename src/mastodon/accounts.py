@@ -0,0 +1,134 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from mastodon import Mastodon
+from src.metrics import registry as metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class AccountDirectory:
+    """Справочник адрес аккаунта (acct) -> id аккаунта Mastodon.
+
+    Ключ - acct: для своего сервера это ник, для федеративных аккаунтов ник@сервер,
+    поэтому одинаковые ники с разных серверов не смешиваются.
+    Заполняется из событий стрима. Поверх таблицы SQLite держится LRU-кэш в памяти,
+    записи старше ttl считаются устаревшими. Поиск через API выполняется только при промахе.
+    Статистика попаданий пишется в лог раз в stats_interval секунд.
+    """
+
+    def __init__(self, mastodon: Mastodon, db_path: str, capacity: int = 10000, ttl_hours: float = 168, namespace: str = None,
+                 stats_interval: float = 600.0):
+        self.mastodon = mastodon
+        self.namespace = namespace
+        self.capacity = capacity
+        self.ttl = ttl_hours * 3600
+        self.stats_interval = stats_interval
+        self._last_report = time.monotonic()
+
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+        self._cache: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS accounts (nick TEXT PRIMARY KEY, account_id TEXT NOT NULL, updated_at REAL NOT NULL)')
+        self._conn.commit()
+
+    def _key(self, nick: str) -> str:
+        # Агенты с разных серверов видят разные id для одного ника
+        return f'{self.namespace}:{nick}' if self.namespace else nick
+
+    def _fresh(self, updated_at: float) -> bool:
+        return time.time() - updated_at < self.ttl
+
+    def _cache_put(self, nick: str, account_id: str, updated_at: float) -> None:
+        self._cache[nick] = (account_id, updated_at)
+        self._cache.move_to_end(nick)
+
+        if len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+    def remember(self, nick: str, account_id: Any) -> None:
+        """Запоминает id аккаунта, увиденный в событии стрима."""
+        account_id = str(account_id)
+        nick = self._key(nick)
+
+        with self._lock:
+            cached = self._cache.get(nick)
+
+            # Не переписываем базу на каждое событие, пока запись свежая
+            if cached and cached[0] == account_id and time.time() - cached[1] < self.ttl / 2:
+                self._cache.move_to_end(nick)
+                return
+
+            now = time.time()
+            self._cache_put(nick, account_id, now)
+            self._conn.execute('INSERT OR REPLACE INTO accounts (nick, account_id, updated_at) VALUES (?, ?, ?)', (nick, account_id, now))
+            self._conn.commit()
+
+    def remember_account(self, account: Dict[str, Any]) -> None:
+        self.remember(account.get('acct') or account['username'], account['id'])
+
+    def _lookup(self, nick: str) -> Optional[str]:
+        nick = self._key(nick)
+
+        with self._lock:
+            cached = self._cache.get(nick)
+
+            if cached and self._fresh(cached[1]):
+                self._cache.move_to_end(nick)
+                self.memory_hits += 1
+                result = 'memory', cached[0]
+
+            else:
+                row = self._conn.execute('SELECT account_id, updated_at FROM accounts WHERE nick = ?', (nick,)).fetchone()
+
+                if row and self._fresh(row[1]):
+                    self._cache_put(nick, row[0], row[1])
+                    self.db_hits += 1
+                    result = 'db', row[0]
+
+                else:
+                    self.misses += 1
+                    result = 'miss', None
+
+        metrics.inc('agent_account_lookups_total', result=result[0])
+
+        return result[1]
+
+    def _report(self) -> None:
+        now = time.monotonic()
+
+        if self.stats_interval and now - self._last_report >= self.stats_interval:
+            self._last_report = now
+            logger.info('Справочник аккаунтов: %s', self.snapshot())
+
+    def resolve(self, nick: str) -> str:
+        """Возвращает id аккаунта по acct (или нику), обращаясь к поиску Mastodon только при промахе."""
+        account_id = self._lookup(nick)
+        self._report()
+
+        if account_id is None:
+            with metrics.timer('agent_mastodon_seconds', method='account_search'):
+                results = self.mastodon.account_search(nick, limit=1)
+
+            metrics.inc('agent_mastodon_calls_total', method='account_search', status='ok')
+            account_id = str(results[0]['id'])
+            self.remember(nick, account_id)
+
+        return account_id
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+                'cached': len(self._cache),
+            }
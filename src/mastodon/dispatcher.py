@@ -0,0 +1,385 @@
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+from src.metrics import registry as metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты типов событий: меньше - раньше; упоминания обгоняют посты ленты
+PRIORITIES = {'mention': 0, 'update': 1}
+
+
+@dataclass
+class Event:
+    """Событие из стрима, ожидающее обработки графом."""
+    thread_id: str
+    state: Dict[str, Any]
+    config: Dict[str, Any]
+    kind: str = 'update'
+    graph: Any = None  # Граф агента, если диспетчер обслуживает несколько агентов
+    created_at: float = field(default_factory=time.monotonic)
+    on_done: Callable[[], None] = None  # Вызывается после обработки, в том числе неудачной
+
+
+class DispatcherStats:
+    """Счетчики диспетчера: глубина очереди, обработанные события, задержки."""
+
+    def __init__(self, window: int = 1000):
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.coalesced = 0
+        self.shed: Dict[Tuple[str, str], int] = {}
+        self.processed = 0
+        self.failed = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.wait_times: Deque[float] = deque(maxlen=window)
+        self.run_times: Deque[float] = deque(maxlen=window)
+
+    def on_submit(self, depth: int) -> None:
+        with self.lock:
+            self.submitted += 1
+            self.queue_depth = depth
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def on_coalesce(self, merged: int) -> None:
+        with self.lock:
+            self.coalesced += merged
+
+    def on_shed(self, kind: str, reason: str) -> None:
+        with self.lock:
+            self.shed[kind, reason] = self.shed.get((kind, reason), 0) + 1
+
+    def on_done(self, depth: int, wait: float, run: float, ok: bool) -> None:
+        with self.lock:
+            self.queue_depth = depth
+            self.wait_times.append(wait)
+            self.run_times.append(run)
+
+            if ok:
+                self.processed += 1
+            else:
+                self.failed += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'shed': {f'{kind}/{reason}': n for (kind, reason), n in self.shed.items()},
+                'processed': self.processed,
+                'failed': self.failed,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'wait_p50': percentile(self.wait_times, 50),
+                'wait_p95': percentile(self.wait_times, 95),
+                'run_p50': percentile(self.run_times, 50),
+                'run_p95': percentile(self.run_times, 95),
+            }
+
+
+def percentile(values: Any, p: float) -> float:
+    """Перцентиль по выборке (0, если выборка пуста)."""
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+
+    return round(ordered[idx], 4)
+
+
+def merge_events(events: List[Event]) -> Event:
+    """Объединяет подряд идущие события одного пользователя в одно.
+
+    В context попадает список batch со всеми текстами и id постов; основным
+    post_id становится последнее упоминание (или последний пост, если упоминаний нет).
+    """
+    if len(events) == 1:
+        return events[0]
+
+    batch = [{
+        'text': e.state['context']['text'],
+        'post_id': e.state['context']['post_id'],
+        'is_mention': e.state['context']['is_mention'],
+    } for e in events]
+
+    mentions = [item for item in batch if item['is_mention']]
+    target = (mentions or batch)[-1]
+    last = events[-1]
+    callbacks = [e.on_done for e in events if e.on_done is not None]
+
+    def on_done() -> None:
+        for callback in callbacks:
+            callback()
+
+    state = dict(last.state)
+    state['context'] = {
+        'text': target['text'],
+        'post_id': target['post_id'],
+        'is_mention': bool(mentions),
+        'user': last.state['context']['user'],
+        'acct': last.state['context'].get('acct'),
+        'batch': batch,
+    }
+
+    return Event(
+        thread_id=last.thread_id,
+        state=state,
+        config=last.config,
+        kind='mention' if mentions else last.kind,
+        graph=last.graph,
+        created_at=events[0].created_at,
+        on_done=on_done,
+    )
+
+
+class EventDispatcher:
+    """Выполняет вызовы графа в пуле потоков.
+
+    События одного thread_id обрабатываются строго в порядке поступления,
+    события разных пользователей - параллельно. Пользователи с упоминаниями в очереди
+    берутся в работу раньше пользователей только с постами ленты. При coalesce_window > 0
+    события пользователя, пришедшие в течение окна после первого, объединяются в один
+    вызов графа (не более max_batch событий).
+
+    Очередь ограничена max_queue событиями: при переполнении новый пост ленты
+    отбрасывается, а упоминание вытесняет самый старый пост ленты; если вытеснять
+    нечего, упоминание все равно принимается - предел действует только на посты ленты.
+    События старше deadlines[kind] секунд отбрасываются перед обработкой.
+    Отброшенные события учитываются в stats.shed по типу и причине.
+    """
+
+    def __init__(self, graph: Any = None, workers: int = 4, stats_interval: float = 60.0, coalesce_window: float = 0.0, max_batch: int = 5,
+                 max_queue: int = 0, deadlines: Dict[str, float] = None):
+        self.graph = graph
+        self.workers = workers
+        self.stats_interval = stats_interval
+        self.coalesce_window = coalesce_window
+        self.max_batch = max_batch if coalesce_window else 1
+        self.max_queue = max_queue
+        self.deadlines = deadlines or {}
+        self.stats = DispatcherStats()
+
+        self._pending: Dict[str, Deque[Event]] = {}
+        # Очереди готовых пользователей по приоритетам; актуальный приоритет - в _ready_at,
+        # устаревшие записи (после повышения приоритета) пропускаются при выборке
+        self._ready: Dict[int, Deque[str]] = {p: deque() for p in sorted(set(PRIORITIES.values()) | {self._lowest()})}
+        self._ready_at: Dict[str, int] = {}
+        self._active: Set[str] = set()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+        self._last_report = time.monotonic()
+
+    @staticmethod
+    def _lowest() -> int:
+        return max(PRIORITIES.values()) + 1
+
+    def _priority(self, kind: str) -> int:
+        return PRIORITIES.get(kind, self._lowest())
+
+    def start(self) -> None:
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'dispatcher-{n}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _mark_ready(self, thread_id: str, priority: int) -> None:
+        if thread_id in self._active:
+            return
+
+        if priority < self._ready_at.get(thread_id, priority + 1):
+            self._ready_at[thread_id] = priority
+            self._ready[priority].append(thread_id)
+
+    def _pop_ready(self) -> Optional[str]:
+        for priority, queue in self._ready.items():
+            while queue:
+                thread_id = queue.popleft()
+
+                if self._ready_at.get(thread_id) == priority:
+                    del self._ready_at[thread_id]
+                    return thread_id
+
+        return None
+
+    def _evict_update(self) -> Optional[Event]:
+        """Убирает из очереди самое старое событие с наименьшим приоритетом."""
+        lowest = self._priority('update')
+        victim = None
+
+        for queue in self._pending.values():
+            for event in queue:
+                if self._priority(event.kind) >= lowest and (victim is None or event.created_at < victim.created_at):
+                    victim = event
+
+        if victim is None:
+            return None
+
+        queue = self._pending[victim.thread_id]
+        queue.remove(victim)
+        self._size -= 1
+
+        if not queue and victim.thread_id not in self._active:
+            del self._pending[victim.thread_id]
+            self._ready_at.pop(victim.thread_id, None)
+
+        return victim
+
+    def _shed(self, events: List[Event], reason: str) -> None:
+        for event in events:
+            self.stats.on_shed(event.kind, reason)
+            metrics.inc('agent_events_shed_total', kind=event.kind, reason=reason)
+            logger.info('Событие %s пользователя %s отброшено (%s)', event.kind, event.thread_id, reason)
+
+            # Отброшенное событие считается обработанным, чтобы не догружать его повторно
+            if event.on_done is not None:
+                event.on_done()
+
+    def submit(self, event: Event) -> None:
+        """Ставит событие в очередь своего пользователя, не блокируя поток стрима."""
+        shed, accepted = [], True
+
+        with self._cond:
+            if self.max_queue and self._size >= self.max_queue:
+                if self._priority(event.kind) >= self._priority('update'):
+                    accepted = False
+
+                else:
+                    # Упоминание не ждет места и не отбрасывается: отброшенное считалось бы
+                    # обработанным и не догрузилось бы после переподключения
+                    victim = self._evict_update()
+
+                    if victim is not None:
+                        shed.append(victim)
+
+            if accepted:
+                queue = self._pending.setdefault(event.thread_id, deque())
+                queue.append(event)
+                self._size += 1
+                self._mark_ready(event.thread_id, self._priority(event.kind))
+
+                self.stats.on_submit(self._size)
+                metrics.set_gauge('agent_queue_depth', self._size)
+                self._cond.notify_all()
+
+        self._shed(shed if accepted else [event], 'overflow')
+
+    def join(self) -> None:
+        """Ждет, пока все поставленные события будут обработаны."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._size == 0 and not self._active)
+
+    def stop(self, wait: bool = True) -> None:
+        if wait:
+            self.join()
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+
+        self._threads = []
+
+    def _is_stale(self, event: Event, now: float) -> bool:
+        deadline = self.deadlines.get(event.kind)
+
+        return bool(deadline) and now - event.created_at > deadline
+
+    def _take(self) -> Optional[Event]:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready_at or self._stopping)
+
+                thread_id = self._pop_ready()
+
+                if thread_id is None:
+                    return None
+
+                self._active.add(thread_id)
+                queue = self._pending[thread_id]
+
+                # Ждем остальные события пользователя до конца окна объединения
+                deadline = queue[0].created_at + self.coalesce_window
+                while len(queue) < self.max_batch and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+
+                    self._cond.wait(remaining)
+
+                events = [queue.popleft() for _ in range(min(len(queue), self.max_batch))]
+                self._size -= len(events)
+                self._cond.notify_all()
+
+            now = time.monotonic()
+            fresh, stale = [], []
+            for e in events:
+                (stale if self._is_stale(e, now) else fresh).append(e)
+
+            self._shed(stale, 'stale')
+
+            if fresh:
+                if len(fresh) > 1:
+                    self.stats.on_coalesce(len(fresh) - 1)
+
+                return merge_events(fresh)
+
+            self._release(thread_id)
+
+    def _release(self, thread_id: str) -> None:
+        with self._cond:
+            self._active.discard(thread_id)
+
+            if self._pending[thread_id]:
+                self._mark_ready(thread_id, min(self._priority(e.kind) for e in self._pending[thread_id]))
+            else:
+                del self._pending[thread_id]
+
+            self._cond.notify_all()
+
+    def _worker(self) -> None:
+        while True:
+            event = self._take()
+
+            if event is None:
+                return
+
+            try:
+                self._process(event)
+            finally:
+                self._release(event.thread_id)
+
+    def _process(self, event: Event) -> None:
+        started = time.monotonic()
+        ok = True
+
+        try:
+            (event.graph or self.graph).invoke(event.state, config=event.config)
+
+        except Exception:
+            ok = False
+            logger.exception('Ошибка обработки события %s пользователя %s', event.kind, event.thread_id)
+
+        if event.on_done is not None:
+            event.on_done()
+
+        finished = time.monotonic()
+        wait, run = started - event.created_at, finished - started
+
+        self.stats.on_done(self._size, wait, run, ok)
+        metrics.observe('agent_event_seconds', run, kind=event.kind, status='ok' if ok else 'error')
+        metrics.set_gauge('agent_queue_depth', self._size)
+        logger.debug('Событие %s пользователя %s: ожидание %.3fs, обработка %.3fs', event.kind, event.thread_id, wait, run)
+
+        if self.stats_interval and finished - self._last_report >= self.stats_interval:
+            self._last_report = finished
+            logger.info('Диспетчер: %s', self.stats.snapshot())
@@ -0,0 +1,163 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+from mastodon import Mastodon
+from src.metrics import registry as metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def id_key(event_id: Any) -> Tuple[int, str]:
+    """Ключ сортировки id Mastodon: числовые строки разной длины сравниваются как числа."""
+    event_id = str(event_id)
+
+    return len(event_id), event_id
+
+
+class ProcessedIndex:
+    """Персистентный индекс обработанных статусов и уведомлений.
+
+    Хранится в таблицах рядом с чекпоинтами. Последние id держатся в ограниченном
+    LRU в памяти, остальные проверяются по первичному ключу в SQLite.
+    Для каждого типа событий запоминается курсор - id, до которого включительно
+    обработаны все взятые в работу события; с него начинается догрузка пропущенного
+    после переподключения или перезапуска.
+    """
+
+    def __init__(self, db_path: str, memory_size: int = 50000, keep_days: float = 30, namespace: str = None):
+        self.namespace = namespace
+        self.memory_size = memory_size
+        self.keep_days = keep_days
+
+        self._recent: 'OrderedDict[Tuple[str, str], None]' = OrderedDict()
+        self._in_progress: Set[Tuple[str, str]] = set()
+        self._held: Dict[str, str] = {}  # Наибольший завершенный id, которого курсор еще не может достичь
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS processed_events (
+                kind TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                processed_at REAL NOT NULL,
+                PRIMARY KEY (kind, event_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS stream_cursor (
+                kind TEXT PRIMARY KEY,
+                last_id TEXT NOT NULL
+            );
+            """
+        )
+        self.prune()
+
+    def _kind(self, kind: str) -> str:
+        return f'{self.namespace}:{kind}' if self.namespace else kind
+
+    def _remember(self, key: Tuple[str, str]) -> None:
+        self._recent[key] = None
+        self._recent.move_to_end(key)
+
+        if len(self._recent) > self.memory_size:
+            self._recent.popitem(last=False)
+
+    def claim(self, kind: str, event_id: Any) -> bool:
+        """Отмечает событие как взятое в работу; False, если оно уже обработано или обрабатывается."""
+        key = (self._kind(kind), str(event_id))
+
+        with self._lock:
+            if key in self._recent or key in self._in_progress:
+                return False
+
+            if self._conn.execute('SELECT 1 FROM processed_events WHERE kind = ? AND event_id = ?', key).fetchone():
+                self._remember(key)
+                return False
+
+            self._in_progress.add(key)
+
+        return True
+
+    def complete(self, kind: str, event_id: Any) -> None:
+        """Сохраняет событие как обработанное и сдвигает курсор догрузки."""
+        key = (self._kind(kind), str(event_id))
+
+        with self._lock:
+            self._in_progress.discard(key)
+            self._remember(key)
+
+            self._conn.execute('INSERT OR IGNORE INTO processed_events (kind, event_id, processed_at) VALUES (?, ?, ?)', key + (time.time(),))
+
+            kind, held = key
+            if kind in self._held and id_key(self._held[kind]) > id_key(held):
+                held = self._held[kind]
+
+            # События обрабатываются параллельно и завершаются не по порядку. Курсор не
+            # обгоняет более старые события в работе, иначе после падения они не догрузятся
+            if any(k == kind and id_key(i) < id_key(held) for k, i in self._in_progress):
+                self._held[kind] = held
+
+            else:
+                self._held.pop(kind, None)
+                last_id = self._last_id(kind)
+
+                if last_id is None or id_key(held) > id_key(last_id):
+                    self._conn.execute('INSERT OR REPLACE INTO stream_cursor (kind, last_id) VALUES (?, ?)', (kind, held))
+
+            self._conn.commit()
+
+    def _last_id(self, kind: str) -> Optional[str]:
+        row = self._conn.execute('SELECT last_id FROM stream_cursor WHERE kind = ?', (kind,)).fetchone()
+
+        return row[0] if row else None
+
+    def last_id(self, kind: str) -> Optional[str]:
+        with self._lock:
+            return self._last_id(self._kind(kind))
+
+    def prune(self) -> None:
+        """Удаляет записи старше keep_days, чтобы индекс не рос бесконечно."""
+        with self._lock:
+            self._conn.execute('DELETE FROM processed_events WHERE processed_at < ?', (time.time() - self.keep_days * 86400,))
+            self._conn.commit()
+
+
+def catch_up(mastodon: Mastodon, listener: Any, index: ProcessedIndex, page_size: int = 40, max_pages: int = 25) -> int:
+    """Догружает статусы ленты и упоминания, пришедшие после последнего обработанного id.
+
+    События передаются в listener пачками, от старых к новым; повторы отсекает индекс.
+    При первом запуске (курсора еще нет) догрузка не выполняется.
+    """
+    sources = (
+        ('status', 'timeline_home', lambda **kwargs: mastodon.timeline_home(**kwargs), listener.on_update),
+        ('notification', 'notifications', lambda **kwargs: mastodon.notifications(types=['mention'], **kwargs), listener.on_notification),
+    )
+    total = 0
+
+    for kind, method, fetch, handle in sources:
+        cursor = index.last_id(kind)
+
+        if cursor is None:
+            continue
+
+        for _ in range(max_pages):
+            # min_id листает от курсора в сторону новых событий
+            with metrics.timer('agent_mastodon_seconds', method=method):
+                page = sorted(fetch(min_id=cursor, limit=page_size), key=lambda item: id_key(item['id']))
+
+            metrics.inc('agent_mastodon_calls_total', method=method, status='ok')
+
+            if not page:
+                break
+
+            for item in page:
+                handle(item)
+
+            total += len(page)
+            cursor = page[-1]['id']
+
+    logger.info('Догружено %d пропущенных событий', total)
+
+    return total
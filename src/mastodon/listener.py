@@ -1,59 +1,128 @@
 from mastodon import StreamListener
-from sqlalchemy.testing.plugin.plugin_base import config
 
 from src.models.user_profile import UserProfile
+from src.mastodon.dispatcher import EventDispatcher, Event
+from src.mastodon.accounts import AccountDirectory
+from src.mastodon.relevance import RelevanceFilter
+from src.mastodon.event_log import ProcessedIndex
+from src.mastodon.normalize import normalize_status, html_to_text
+from src.metrics import registry as metrics
 from mastodon import Mastodon
 from typing import Any
-from bs4 import BeautifulSoup
+from urllib.parse import urlparse
 
 
 class BotStreamListener(StreamListener):
-    def __init__(self, graph: Any, profile: UserProfile, mastodon: Mastodon):
+    def __init__(self, dispatcher: EventDispatcher, profile: UserProfile, mastodon: Mastodon, accounts: AccountDirectory = None, relevance: RelevanceFilter = None, processed: ProcessedIndex = None, graph: Any = None, namespace: str = None):
         super().__init__()
-        self.graph = graph
+        self.dispatcher = dispatcher
         self.profile = profile
         self.mastodon = mastodon
+        self.accounts = accounts
+        self.relevance = relevance
+        self.processed = processed
+        self.graph = graph
+        self.namespace = namespace
+        # Сервер агента: упоминание ник@этот сервер - тоже упоминание агента
+        self.domain = urlparse(getattr(mastodon, 'api_base_url', None) or '').netloc or None
+
+    def _thread_id(self, user: str) -> str:
+        # В одном процессе с несколькими агентами треды памяти разделяются по агенту
+        return f'{self.namespace}:{user}' if self.namespace else user
+
+    def _claim(self, kind: str, event_id: int) -> bool:
+        return self.processed is None or self.processed.claim(kind, event_id)
+
+    def _complete(self, kind: str, event_id: int) -> None:
+        if self.processed is not None:
+            self.processed.complete(kind, event_id)
 
     def on_update(self, status: dict):
         """Обрабатывает новые посты в ленте."""
-        text = BeautifulSoup(status['content'], "html.parser").get_text()
+        with metrics.timer('agent_listener_seconds', callback='update'):
+            self._handle_update(status)
+
+    def on_notification(self, notification: dict):
+        """Обрабатывает упоминания бота."""
+        with metrics.timer('agent_listener_seconds', callback='notification'):
+            self._handle_notification(notification)
+
+    def _handle_update(self, status: dict):
+        if not self._claim('status', status['id']):
+            metrics.inc('agent_events_total', kind='update', decision='duplicate')
+            return
+
+        normalized = normalize_status(status)
+        text = normalized.text
         user =  status['account']['username']
 
-        if user != self.profile.nick and not status['in_reply_to_id'] and '@tcar' not in text:
+        if self.accounts is not None:
+            self.accounts.remember_account(status['account'])
+
+        # Посты с упоминанием бота приходят еще и уведомлением, обрабатываются там
+        if user != self.profile.nick and not status['in_reply_to_id'] and not normalized.mentions_nick(self.profile.nick, self.domain):
+            # Нерелевантные посты отсекаются до обращения к LLM
+            if self.relevance is not None and not self.relevance.admit(text, user):
+                metrics.inc('agent_events_total', kind='update', decision='filtered')
+                self._complete('status', status['id'])
+                return
+
             post_id = status['id']
 
             state = {
-                'profile': self.profile,
+                'profile_id': self.profile.nick,
                 'context': {
                     'text': text,
                     'post_id': post_id,
                     'is_mention': False,
-                    'user': user
+                    'user': user,
+                    'acct': status['account']['acct'],
                 }
             }
 
-            config = {"configurable": {"thread_id": user}, "recursion_limit": 8}
+            thread_id = self._thread_id(user)
+            config = {"configurable": {"thread_id": thread_id}}
 
-            self.graph.invoke(state, config=config)
+            self.dispatcher.submit(Event(thread_id=thread_id, state=state, config=config, kind='update', graph=self.graph,
+                                         on_done=lambda: self._complete('status', post_id)))
+            metrics.inc('agent_events_total', kind='update', decision='submitted')
+
+        else:
+            metrics.inc('agent_events_total', kind='update', decision='ignored')
+            self._complete('status', status['id'])
+
+    def _handle_notification(self, notification: dict):
+        if not self._claim('notification', notification['id']):
+            metrics.inc('agent_events_total', kind='notification', decision='duplicate')
+            return
 
-    def on_notification(self, notification: dict):
-        """Обрабатывает упоминания бота."""
         user =  notification['account']['username']
 
+        if self.accounts is not None:
+            self.accounts.remember_account(notification['account'])
+
         if notification['type'] == 'mention':
-            text =  BeautifulSoup(notification['status']['content'], "html.parser").get_text()
+            text = html_to_text(notification['status']['content'])
             mention_id = notification['status']['id']
 
             state = {
-                'profile': self.profile,
+                'profile_id': self.profile.nick,
                 'context': {
                     'text': text,
                     'post_id': mention_id,
                     'is_mention': True,
                     'user': user,
+                    'acct': notification['account']['acct'],
                 }
             }
 
-            config = {"configurable": {"thread_id": user}, "recursion_limit": 8}
+            thread_id = self._thread_id(user)
+            config = {"configurable": {"thread_id": thread_id}}
+
+            self.dispatcher.submit(Event(thread_id=thread_id, state=state, config=config, kind='mention', graph=self.graph,
+                                         on_done=lambda: self._complete('notification', notification['id'])))
+            metrics.inc('agent_events_total', kind='mention', decision='submitted')
 
-            self.graph.invoke(state, config=config)
\ No newline at end of file
+        else:
+            metrics.inc('agent_events_total', kind=notification['type'], decision='ignored')
+            self._complete('notification', notification['id'])
\ No newline at end of file
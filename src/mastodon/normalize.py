@@ -0,0 +1,130 @@
+import re
+from dataclasses import dataclass, field
+from html import unescape
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+
+# Тег, комментарий или текст между тегами; одиночный '<' без тега считается текстом
+TOKEN_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)([^<>]*)>|<!--.*?-->|([^<]+|<)', re.S)
+ATTR_RE = re.compile(r'([a-zA-Z-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+
+BLOCK_TAGS = frozenset({'p', 'blockquote', 'li', 'ul', 'ol', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'})
+
+
+@dataclass
+class NormalizedStatus:
+    """Текст статуса без разметки и его структура: упоминания, хэштеги и ссылки."""
+    text: str
+    mentions: List[str] = field(default_factory=list)  # Адреса упомянутых (acct): ник на своем сервере, ник@сервер на чужих
+    tags: List[str] = field(default_factory=list)
+    links: List[str] = field(default_factory=list)
+
+    def mentions_nick(self, nick: str, domain: str = None) -> bool:
+        """Упомянут ли аккаунт своего сервера; одноименный аккаунт с другого сервера не считается."""
+        accts = {nick.lower()}
+
+        if domain:
+            accts.add(f'{nick}@{domain}'.lower())
+
+        return any(m.lower() in accts for m in self.mentions)
+
+
+def attributes(raw: str) -> Dict[str, str]:
+    return {m.group(1).lower(): unescape(m.group(2) or m.group(3) or m.group(4) or '') for m in ATTR_RE.finditer(raw)}
+
+
+def html_to_text(html: str, anchors: Optional[List[Dict[str, str]]] = None) -> str:
+    """Текст HTML-содержимого статуса за один проход, без построения дерева.
+
+    Абзацы разделяются пустой строкой, <br> - переводом строки. Если передан
+    список anchors, в него добавляются ссылки <a> с атрибутами href, class и текстом.
+    """
+    if '<' not in html:
+        return unescape(html) if '&' in html else html
+
+    parts: List[str] = []
+    anchor: Optional[Dict[str, str]] = None
+    anchor_text: List[str] = []
+
+    for match in TOKEN_RE.finditer(html):
+        text = match.group(4)
+
+        if text is not None:
+            if '&' in text:
+                text = unescape(text)
+
+            parts.append(text)
+
+            if anchor is not None:
+                anchor_text.append(text)
+
+            continue
+
+        name = match.group(2)
+        if name is None:
+            continue
+
+        name = name.lower()
+        closing = match.group(1) == '/'
+
+        if name == 'br':
+            parts.append('\n')
+
+        elif name in BLOCK_TAGS:
+            if not closing and parts:
+                parts.append('\n\n')
+
+        elif name == 'a' and anchors is not None:
+            if not closing:
+                attrs = attributes(match.group(3))
+                anchor, anchor_text = {'href': attrs.get('href', ''), 'class': attrs.get('class', '')}, []
+
+            elif anchor is not None:
+                anchor['text'] = ''.join(anchor_text)
+                anchors.append(anchor)
+                anchor = None
+
+    return ''.join(parts).strip()
+
+
+def mention_acct(anchor: Dict[str, str]) -> str:
+    """Полный адрес ник@сервер из ссылки-упоминания: в тексте обычно только ник, сервер берется из href."""
+    acct = anchor['text'].lstrip('@')
+
+    if '@' not in acct:
+        host = urlparse(anchor['href']).netloc
+        if host:
+            acct = f'{acct}@{host}'
+
+    return acct
+
+
+def normalize_status(status: Dict[str, Any]) -> NormalizedStatus:
+    """Нормализует статус из API Mastodon.
+
+    Упоминания и хэштеги берутся из структурных полей mentions и tags, а если их
+    нет - из разметки ссылок. Ссылками считаются остальные <a> в тексте.
+    """
+    anchors: List[Dict[str, str]] = []
+    text = html_to_text(status.get('content') or '', anchors)
+
+    mentions = [m['acct'] for m in status.get('mentions') or []]
+    tags = [t['name'] for t in status.get('tags') or []]
+    links = []
+
+    for anchor in anchors:
+        classes = anchor['class'].split()
+
+        if 'hashtag' in classes:
+            if not status.get('tags'):
+                tags.append(anchor['text'].lstrip('#'))
+
+        elif 'mention' in classes:
+            if not status.get('mentions'):
+                mentions.append(mention_acct(anchor))
+
+        elif anchor['href'] and anchor['href'] not in links:
+            links.append(anchor['href'])
+
+    return NormalizedStatus(text=text, mentions=mentions, tags=tags, links=links)
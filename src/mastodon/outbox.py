@@ -0,0 +1,295 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from mastodon import Mastodon, MastodonRatelimitError, MastodonNetworkError, MastodonServerError
+from src.mastodon.dispatcher import percentile
+from src.metrics import registry as metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Методы Mastodon, которые выполняются через очередь
+WRITE_METHODS = ('status_post', 'status_favourite', 'account_follow', 'account_unfollow')
+
+# Пары противоположных действий: пока ни одно не отправлено, остается только последнее
+OPPOSITES = {'account_follow': 'account_unfollow', 'account_unfollow': 'account_follow'}
+
+
+@dataclass
+class OutboundAction:
+    """Отложенный вызов API Mastodon."""
+    method: str
+    args: Tuple
+    kwargs: Dict[str, Any]
+    key: Optional[Tuple] = None
+    created_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+    cancelled: bool = False
+
+
+class TokenBucket:
+    """Ведро токенов, подстраивающееся под заголовки X-RateLimit-* сервера."""
+
+    def __init__(self, limit: int = 300, period: float = 300.0):
+        self.capacity = limit
+        self.tokens = float(limit)
+        self.rate = limit / period
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько ждать до появления токена."""
+        self._refill()
+
+        if self.tokens >= 1:
+            return 0.0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self._refill()
+        self.tokens -= 1
+
+    def sync(self, limit: int, remaining: int, reset: float) -> None:
+        """Равномерно распределяет оставшиеся запросы до сброса окна лимита."""
+        window = max(reset - time.time(), 1.0)
+
+        self.capacity = max(limit, 1)
+        self.tokens = min(self.tokens, float(remaining))
+        self.rate = max(remaining, 1) / window
+        self.updated = time.monotonic()
+
+
+class Outbox:
+    """Очередь исходящих действий Mastodon.
+
+    Подменяет клиент Mastodon для графа: запись (посты, лайки, подписки) ставится
+    в очередь и отправляется фоновым потоком с учетом лимитов сервера, повторами
+    с экспоненциальной задержкой и схлопыванием избыточных операций.
+    Остальные методы вызываются у клиента напрямую. Статистика очереди пишется
+    в лог раз в stats_interval секунд.
+    """
+
+    def __init__(self, mastodon: Mastodon, retries: int = 5, backoff: float = 2.0, max_backoff: float = 300.0,
+                 stats_interval: float = 60.0):
+        self.mastodon = mastodon
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats_interval = stats_interval
+        self.bucket = TokenBucket()
+        self._last_report = time.monotonic()
+
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.throttled = 0
+        self.retried = 0
+        self.latencies: Deque[float] = deque(maxlen=1000)
+
+        self._heap: List[Tuple[float, int, OutboundAction]] = []
+        self._pending: Dict[Tuple, OutboundAction] = {}
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        if name in WRITE_METHODS:
+            return lambda *args, **kwargs: self.enqueue(name, *args, **kwargs)
+
+        return getattr(self.mastodon, name)
+
+    @staticmethod
+    def _key(method: str, args: Tuple, kwargs: Dict[str, Any]) -> Optional[Tuple]:
+        if method == 'status_post':
+            return method, args[0] if args else kwargs.get('status'), kwargs.get('in_reply_to_id')
+
+        return method, str(args[0] if args else next(iter(kwargs.values())))
+
+    def enqueue(self, method: str, *args, **kwargs) -> None:
+        key = self._key(method, args, kwargs)
+
+        with self._cond:
+            if key in self._pending:
+                self.coalesced += 1
+                logger.debug('Повторное действие %s схлопнуто', key)
+                return
+
+            # Побеждает последнее решение: неотправленное противоположное действие отменяется,
+            # новое ставится в очередь (отписка уже отправленной подписки должна дойти до сервера)
+            opposite = (OPPOSITES.get(method),) + key[1:]
+            if opposite in self._pending:
+                self._pending.pop(opposite).cancelled = True
+                self.coalesced += 1
+                logger.debug('Действие %s отменено более поздним %s', opposite, key)
+
+            action = OutboundAction(method=method, args=args, kwargs=kwargs, key=key)
+            self._pending[key] = action
+            self._push(action, time.monotonic())
+
+    def _push(self, action: OutboundAction, ready_at: float) -> None:
+        heapq.heappush(self._heap, (ready_at, next(self._seq), action))
+        self._cond.notify_all()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._worker, name='outbox', daemon=True)
+        self._thread.start()
+
+    def join(self) -> None:
+        """Ждет отправки всех действий из очереди."""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pending and not self._in_flight)
+
+    def stop(self, wait: bool = True) -> None:
+        if wait:
+            self.join()
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def _take(self) -> Optional[OutboundAction]:
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                ready_at, _, action = self._heap[0]
+                delay = max(ready_at - time.monotonic(), self.bucket.delay())
+
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+
+                if not action.cancelled:
+                    # Отправляемое действие уже нельзя схлопнуть с новыми
+                    del self._pending[action.key]
+                    self._in_flight += 1
+                    self.bucket.take()
+                    return action
+
+    def _worker(self) -> None:
+        while True:
+            action = self._take()
+
+            if action is None:
+                return
+
+            self._send(action)
+
+            now = time.monotonic()
+            if self.stats_interval and now - self._last_report >= self.stats_interval:
+                self._last_report = now
+                logger.info('Очередь исходящих: %s', self.snapshot())
+
+    def _send(self, action: OutboundAction) -> None:
+        action.attempts += 1
+        retry_at, ok = None, False
+
+        status = 'error'
+        started = time.perf_counter()
+
+        try:
+            getattr(self.mastodon, action.method)(*action.args, **action.kwargs)
+            ok, status = True, 'ok'
+
+        except MastodonRatelimitError:
+            status = 'ratelimited'
+            retry_at = time.monotonic() + max(self.mastodon.ratelimit_reset - time.time(), 1.0)
+            logger.warning('Достигнут лимит запросов Mastodon, %s отложено до сброса лимита', action.method)
+
+        except (MastodonNetworkError, MastodonServerError) as e:
+            if action.attempts <= self.retries:
+                retry_at = time.monotonic() + min(self.backoff ** action.attempts, self.max_backoff)
+                logger.warning('Ошибка %s (попытка %d): %s', action.method, action.attempts, e)
+
+            else:
+                logger.error('Действие %s не выполнено после %d попыток: %s', action.method, action.attempts, e)
+
+        except Exception:
+            logger.exception('Действие %s не выполнено', action.method)
+
+        metrics.observe('agent_mastodon_seconds', time.perf_counter() - started, method=action.method)
+        metrics.inc('agent_mastodon_calls_total', method=action.method, status=status)
+
+        self._sync_bucket()
+
+        with self._cond:
+            self._in_flight -= 1
+
+            # Счетчики меняются под тем же замком, под которым их читает snapshot
+            if status == 'ratelimited':
+                self.throttled += 1
+
+            if retry_at is not None:
+                self.retried += 1
+
+                # За время отправки поставлено противоположное действие: оно более позднее
+                # и побеждает, повтор отменяется
+                opposite = (OPPOSITES.get(action.method),) + action.key[1:]
+                if opposite in self._pending:
+                    self.coalesced += 1
+                    logger.debug('Повтор %s отменен более поздним %s', action.key, opposite)
+
+                # Если за время отправки поставлено такое же действие, повтор не нужен
+                elif action.key not in self._pending:
+                    self._pending[action.key] = action
+                    self._push(action, retry_at)
+
+                self._cond.notify_all()
+                return
+
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+            latency = time.monotonic() - action.created_at
+            self.latencies.append(latency)
+            self._cond.notify_all()
+
+        # Время от постановки в очередь до завершения, включая ожидание лимитов и повторы
+        metrics.observe('agent_outbox_latency_seconds', latency, method=action.method, status=status)
+
+    def _sync_bucket(self) -> None:
+        remaining = getattr(self.mastodon, 'ratelimit_remaining', None)
+
+        if remaining is not None:
+            self.bucket.sync(self.mastodon.ratelimit_limit, remaining, self.mastodon.ratelimit_reset)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'queued': len(self._pending),
+                'in_flight': self._in_flight,
+                'sent': self.sent,
+                'failed': self.failed,
+                'coalesced': self.coalesced,
+                'throttled': self.throttled,
+                'retried': self.retried,
+                'latency_p50': percentile(self.latencies, 50),
+                'latency_p95': percentile(self.latencies, 95),
+            }
@@ -0,0 +1,99 @@
+import logging
+import random
+import re
+import threading
+from typing import Dict, List, Set
+
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Частые окончания русских слов, которые отбрасываются при грубом стемминге
+SUFFIXES = sorted([
+    'иями', 'ями', 'ами', 'ией', 'иям', 'ием', 'иях', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'ой', 'ей', 'ам', 'ям', 'ах', 'ях', 'ом', 'ем',
+    'ов', 'ев', 'ию', 'ия', 'ии', 'ть', 'ся', 'ешь', 'ет', 'ют', 'ут', 'ит', 'ат', 'ят',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+
+MIN_STEM = 3
+
+
+def stem(word: str) -> str:
+    word = word.lower()
+
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM:
+            return word[:-len(suffix)]
+
+    return word
+
+
+def stems(text: str) -> Set[str]:
+    return {stem(w) for w in WORD_RE.findall(text)}
+
+
+def matches(interest_stem: str, text_stems: Set[str]) -> bool:
+    # Короткие основы (например, «ИИ») сравниваются целиком, длинные - по префиксу.
+    # Основа из текста должна начинаться с основы интереса, а не наоборот: иначе
+    # короткие слова вроде «тех» совпадали бы с «технологиями»
+    if len(interest_stem) < MIN_STEM:
+        return interest_stem in text_stems
+
+    return any(s.startswith(interest_stem) for s in text_stems)
+
+
+class RelevanceFilter:
+    """Дешевая локальная оценка релевантности поста интересам агента.
+
+    Оценка - доля слов лучшего совпавшего интереса, найденных в тексте (после стемминга).
+    Посты ниже порога не доходят до LLM, кроме случайной выборки sample_rate.
+    """
+
+    def __init__(self, interests: List[str], threshold: float = 0.5, sample_rate: float = 0.1, seed: int = None):
+        self.interests = {interest: stems(interest) for interest in interests}
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.random = random.Random(seed)
+
+        self.passed = 0
+        self.sampled = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def score(self, text: str) -> float:
+        text_stems = stems(text)
+        best = 0.0
+
+        for interest_stems in self.interests.values():
+            if interest_stems:
+                hit = sum(matches(s, text_stems) for s in interest_stems)
+                best = max(best, hit / len(interest_stems))
+
+        return best
+
+    def admit(self, text: str, user: str = None) -> bool:
+        """Решает, передавать ли пост из ленты в граф."""
+        score = self.score(text)
+
+        with self._lock:
+            if score >= self.threshold:
+                decision = 'pass'
+                self.passed += 1
+
+            elif self.random.random() < self.sample_rate:
+                decision = 'sample'
+                self.sampled += 1
+
+            else:
+                decision = 'drop'
+                self.dropped += 1
+
+        logger.info('Релевантность поста %s: %.2f (порог %.2f) -> %s', user, score, self.threshold, decision)
+
+        return decision != 'drop'
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {'passed': self.passed, 'sampled': self.sampled, 'dropped': self.dropped}
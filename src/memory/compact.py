@@ -0,0 +1,26 @@
+from typing import Any, Dict, List
+
+
+# Роли сообщений хранятся в чекпоинтах одной буквой
+ROLE_CODES = {'user': 'u', 'system': 's', 'assistant': 'a'}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+# Начало системного промпта персоны, который раньше сохранялся первым сообщением истории
+LEGACY_PERSONA_PREFIX = 'Тебя зовут'
+
+
+def encode_history(history: List[Any]) -> List[List[str]]:
+    """Компактная запись истории для чекпоинта: пары [код роли, текст]."""
+    return [[ROLE_CODES.get(m['role'], m['role']), m['content']] if isinstance(m, dict) else list(m) for m in history]
+
+
+def decode_history(entries: List[Any]) -> List[Dict[str, str]]:
+    """Восстанавливает историю в виде сообщений {'role', 'content'}; старые записи-словари принимаются как есть."""
+    return [dict(m) if isinstance(m, dict) else {'role': ROLE_NAMES.get(m[0], m[0]), 'content': m[1]} for m in entries]
+
+
+def drop_legacy_persona(history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    if history and history[0]['content'].startswith(LEGACY_PERSONA_PREFIX):
+        return history[1:]
+
+    return history
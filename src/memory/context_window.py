@@ -0,0 +1,105 @@
+import logging
+from typing import Dict, List, Tuple, Callable
+
+try:
+    import tiktoken
+except ImportError:  # без tiktoken используется грубая оценка по длине текста
+    tiktoken = None
+
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены, которые модель добавляет к каждому сообщению
+MESSAGE_OVERHEAD = 4
+
+
+class TokenCounter:
+    """Подсчет токенов в сообщениях чата."""
+
+    def __init__(self, model: str = 'gpt-4o-mini'):
+        self.encoding = None
+
+        if tiktoken is not None:
+            try:
+                try:
+                    self.encoding = tiktoken.encoding_for_model(model)
+                except KeyError:  # модель неизвестна tiktoken (например, за прокси base_url)
+                    self.encoding = tiktoken.get_encoding('o200k_base')
+            except Exception as e:  # словарь кодировки скачивается при первом использовании и может быть недоступен
+                logger.warning('Кодировка tiktoken недоступна (%s), токены оцениваются по длине текста', e)
+
+    def text(self, text: str) -> int:
+        if self.encoding is None:
+            return len(text) // 4 + 1
+
+        return len(self.encoding.encode(text))
+
+    def messages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.text(m['content']) + MESSAGE_OVERHEAD for m in messages)
+
+
+class ContextWindow:
+    """Окно истории диалога, ограниченное бюджетом токенов.
+
+    Когда история превышает бюджет, старые реплики сворачиваются в резюме.
+    Резюме пересчитывается только при переполнении окна, после чего в окне
+    остается keep_ratio от бюджета, чтобы следующее сворачивание случилось не сразу.
+    """
+
+    def __init__(self, counter: TokenCounter, token_budget: int = 1500, keep_ratio: float = 0.5):
+        self.counter = counter
+        self.token_budget = token_budget
+        self.keep_ratio = keep_ratio
+
+    def overflows(self, history: List[Dict[str, str]]) -> bool:
+        return self.counter.messages(history) > self.token_budget
+
+    def split(self, history: List[Dict[str, str]]) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+        """Делит историю на сворачиваемую часть и оставляемый хвост."""
+        keep_budget = int(self.token_budget * self.keep_ratio)
+        kept, used = [], 0
+
+        for message in reversed(history):
+            cost = self.counter.messages([message])
+            if kept and used + cost > keep_budget:
+                break
+
+            kept.append(message)
+            used += cost
+
+        kept.reverse()
+
+        return history[:len(history) - len(kept)], kept
+
+    def fit(self, history: List[Dict[str, str]], summary: str, summarize: Callable[[str, List[Dict[str, str]]], str]) -> Tuple[List[Dict[str, str]], str]:
+        """Возвращает историю, укладывающуюся в бюджет, и обновленное резюме."""
+        if not self.overflows(history):
+            return history, summary
+
+        folded, kept = self.split(history)
+        if not folded:
+            return history, summary
+
+        logger.info('Окно истории переполнено: сворачиваю %d сообщений в резюме', len(folded))
+
+        return kept, summarize(summary, folded)
+
+    @staticmethod
+    def messages(persona: str, summary: str, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Собирает промпт: неизменный префикс персоны, резюме и окно истории."""
+        prefix = [{'role': 'system', 'content': persona}]
+
+        if summary:
+            prefix.append({'role': 'system', 'content': f'Краткое содержание вашего предыдущего общения: {summary}'})
+
+        return prefix + history
+
+
+def summary_prompt(summary: str, folded: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Промпт для инкрементального обновления резюме."""
+    turns = '\n'.join(f'{m["role"]}: {m["content"]}' for m in folded)
+
+    return [
+        {'role': 'system', 'content': 'Ты ведешь краткое резюме переписки. Обнови резюме, добавив в него новые реплики. Сохрани факты о собеседнике и твои действия, ответ - только текст резюме, не длиннее 5 предложений.'},
+        {'role': 'user', 'content': f'Текущее резюме: {summary or "(пусто)"}\n\nНовые реплики:\n{turns}'},
+    ]
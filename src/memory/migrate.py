@@ -0,0 +1,158 @@
+import argparse
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from typing import Any, Dict, Iterator, List, Tuple
+import yaml
+from langgraph.checkpoint.sqlite import SqliteSaver
+from src.memory.compact import encode_history, decode_history, drop_legacy_persona
+
+
+logger = logging.getLogger(__name__)
+
+
+def profile_id(profile: Any) -> Any:
+    # В зависимости от настроек сериализатора профиль читается объектом или словарем
+    return profile.get('nick') if isinstance(profile, dict) else getattr(profile, 'nick', None)
+
+
+def compact_history(history: Any) -> Any:
+    if not isinstance(history, list):
+        return history
+
+    return encode_history(drop_legacy_persona(decode_history(history)))
+
+
+def migrate_values(values: Dict[str, Any]) -> bool:
+    """Переводит значения каналов состояния в компактный формат; True, если что-то изменилось."""
+    changed = False
+
+    if 'profile' in values:
+        values['profile_id'] = profile_id(values.pop('profile'))
+        changed = True
+
+    if 'chat_history' in values:
+        history = compact_history(values['chat_history'])
+        changed = changed or history != values['chat_history']
+        values['chat_history'] = history
+
+    return changed
+
+
+def migrate_checkpoint(checkpoint: Dict[str, Any]) -> bool:
+    changed = migrate_values(checkpoint.get('channel_values', {}))
+
+    # Версии каналов переносятся вместе со значениями
+    for versions in [checkpoint.get('channel_versions', {})] + list(checkpoint.get('versions_seen', {}).values()):
+        if 'profile' in versions:
+            versions['profile_id'] = versions.pop('profile')
+            changed = True
+
+    if 'profile' in (checkpoint.get('updated_channels') or []):
+        checkpoint['updated_channels'] = ['profile_id' if c == 'profile' else c for c in checkpoint['updated_channels']]
+        changed = True
+
+    return changed
+
+
+class StateMigrator:
+    """Переводит сохраненные состояния агента в компактный формат.
+
+    Профиль заменяется ником (profile_id), история - парами [код роли, текст],
+    системный промпт персоны удаляется из истории. Обрабатываются и чекпоинты,
+    и промежуточные записи каналов (таблица writes). Повторный запуск ничего не меняет.
+    """
+
+    def __init__(self, db_path: str, batch_size: int = 500):
+        self.db_path = db_path
+        self.batch_size = batch_size
+
+    def run(self) -> Tuple[int, int]:
+        before = os.path.getsize(self.db_path)
+
+        with closing(sqlite3.connect(self.db_path, check_same_thread=False)) as conn:
+            serde = SqliteSaver(conn).serde
+            checkpoints = self.migrate_checkpoints(conn, serde)
+            writes = self.migrate_writes(conn, serde)
+
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.execute('VACUUM')
+
+        logger.info('Обновлено чекпоинтов: %d, записей каналов: %d; размер базы %.1f -> %.1f MB',
+                    checkpoints, writes, before / 2 ** 20, os.path.getsize(self.db_path) / 2 ** 20)
+
+        return checkpoints, writes
+
+    def batches(self, conn: sqlite3.Connection, query: str) -> Iterator[List[Tuple]]:
+        # Сначала читаются только rowid, чтобы не обновлять таблицу под открытым курсором
+        rowids = [row[0] for row in conn.execute(f'SELECT rowid FROM ({query})')]
+
+        for i in range(0, len(rowids), self.batch_size):
+            chunk = rowids[i:i + self.batch_size]
+            yield conn.execute(f'SELECT * FROM ({query}) WHERE rowid IN ({",".join("?" * len(chunk))})', chunk).fetchall()
+
+    def migrate_checkpoints(self, conn: sqlite3.Connection, serde: Any) -> int:
+        updated = 0
+
+        for batch in self.batches(conn, 'SELECT rowid, type, checkpoint FROM checkpoints'):
+            changes = []
+
+            for rowid, type_, blob in batch:
+                checkpoint = serde.loads_typed((type_, blob))
+
+                if migrate_checkpoint(checkpoint):
+                    changes.append(serde.dumps_typed(checkpoint) + (rowid,))
+
+            conn.executemany('UPDATE checkpoints SET type = ?, checkpoint = ? WHERE rowid = ?', changes)
+            conn.commit()
+            updated += len(changes)
+
+        return updated
+
+    def migrate_writes(self, conn: sqlite3.Connection, serde: Any) -> int:
+        updated = 0
+
+        for batch in self.batches(conn, "SELECT rowid, channel, type, value FROM writes WHERE channel IN ('profile', 'chat_history')"):
+            changes = []
+
+            for rowid, channel, type_, blob in batch:
+                value = serde.loads_typed((type_, blob))
+
+                if channel == 'profile':
+                    channel, value = 'profile_id', profile_id(value)
+
+                else:
+                    history = compact_history(value)
+
+                    if history == value:
+                        continue
+
+                    value = history
+
+                changes.append((channel,) + serde.dumps_typed(value) + (rowid,))
+
+            conn.executemany('UPDATE writes SET channel = ?, type = ?, value = ? WHERE rowid = ?', changes)
+            conn.commit()
+            updated += len(changes)
+
+        return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перевод базы чекпоинтов агента в компактный формат состояния')
+    parser.add_argument('--config', default='config/config.yaml', help='Путь к конфигурации (берется app.sqlite_path)')
+    parser.add_argument('--db', help='Путь к базе, переопределяет app.sqlite_path')
+    args = parser.parse_args()
+
+    app_config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as file:
+            app_config = yaml.safe_load(file)['app']
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    StateMigrator(args.db or app_config.get('sqlite_path', 'data/memory.sqlite')).run()
+
+
+if __name__ == '__main__':
+    main()
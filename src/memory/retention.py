@@ -0,0 +1,224 @@
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from dataclasses import dataclass, fields
+from typing import Dict, Any
+from uuid import UUID
+import yaml
+
+
+logger = logging.getLogger(__name__)
+
+# Число 100-нс интервалов между эпохой UUID (1582-10-15) и эпохой Unix
+UUID_EPOCH_OFFSET = 0x01B21DD213814000
+
+
+@dataclass
+class RetentionPolicy:
+    """Политика хранения чекпоинтов (0 - ограничение выключено)."""
+    keep_last: int = 0  # Сколько последних чекпоинтов хранить для каждого треда
+    max_idle_days: float = 0  # Через сколько дней бездействия тред удаляется целиком
+    interval_hours: float = 6  # Период фоновой очистки
+    vacuum: bool = True  # Возвращать освободившееся место файловой системе
+    vacuum_pages: int = 1000  # Сколько страниц возвращать за один шаг фоновой очистки
+    vacuum_pause: float = 0.05  # Пауза между шагами, чтобы не задерживать запись чекпоинтов
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'RetentionPolicy':
+        names = {f.name for f in fields(cls)}
+
+        return cls(**{k: v for k, v in (config or {}).items() if k in names})
+
+
+def enable_incremental_vacuum(db_path: str) -> None:
+    """Включает auto_vacuum=INCREMENTAL для новой базы.
+
+    Режим применяется, только пока в базе нет таблиц, поэтому вызывается до
+    создания SqliteSaver. Существующая база переводится в этот режим полным
+    сжатием через CLI (python -m src.memory.retention).
+    """
+    with closing(sqlite3.connect(db_path)) as conn:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+
+def checkpoint_time(checkpoint_id: str) -> float:
+    """Время создания чекпоинта (unix) из его идентификатора UUIDv6."""
+    value = UUID(checkpoint_id).int
+    timestamp = ((value >> 80) << 12) | ((value >> 64) & 0x0FFF)
+
+    return (timestamp - UUID_EPOCH_OFFSET) / 1e7
+
+
+class CheckpointPruner:
+    """Удаляет старые чекпоинты SqliteSaver и сжимает базу.
+
+    Работает через отдельное соединение короткими транзакциями по одному треду,
+    поэтому может выполняться параллельно с работающим ботом.
+    """
+
+    def __init__(self, db_path: str, policy: RetentionPolicy):
+        self.db_path = db_path
+        self.policy = policy
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def prune(self) -> Dict[str, int]:
+        stats = {'threads_dropped': 0, 'checkpoints_deleted': 0, 'writes_deleted': 0}
+
+        with closing(self.connect()) as conn:
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'checkpoints'").fetchone():
+                return stats
+
+            threads = conn.execute('SELECT thread_id, MAX(checkpoint_id) FROM checkpoints GROUP BY thread_id').fetchall()
+            idle_before = time.time() - self.policy.max_idle_days * 86400
+
+            for thread_id, last_id in threads:
+                if self.policy.max_idle_days and checkpoint_time(last_id) < idle_before:
+                    self._drop_thread(conn, thread_id, stats)
+                    stats['threads_dropped'] += 1
+
+                elif self.policy.keep_last:
+                    self._trim_thread(conn, thread_id, stats)
+
+        return stats
+
+    def _drop_thread(self, conn: sqlite3.Connection, thread_id: str, stats: Dict[str, int]) -> None:
+        conn.execute('BEGIN IMMEDIATE')
+        stats['checkpoints_deleted'] += conn.execute('DELETE FROM checkpoints WHERE thread_id = ?', (thread_id,)).rowcount
+        stats['writes_deleted'] += conn.execute('DELETE FROM writes WHERE thread_id = ?', (thread_id,)).rowcount
+        conn.execute('COMMIT')
+
+    def _trim_thread(self, conn: sqlite3.Connection, thread_id: str, stats: Dict[str, int]) -> None:
+        conn.execute('BEGIN IMMEDIATE')
+
+        for (checkpoint_ns,) in conn.execute('SELECT DISTINCT checkpoint_ns FROM checkpoints WHERE thread_id = ?', (thread_id,)).fetchall():
+            boundary = conn.execute(
+                'SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?',
+                (thread_id, checkpoint_ns, self.policy.keep_last - 1)
+            ).fetchone()
+
+            if boundary is None:
+                continue
+
+            args = (thread_id, checkpoint_ns, boundary[0])
+            stats['checkpoints_deleted'] += conn.execute('DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?', args).rowcount
+            stats['writes_deleted'] += conn.execute('DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?', args).rowcount
+
+        conn.execute('COMMIT')
+
+    def compact(self) -> None:
+        """Переносит WAL в основной файл и пересобирает базу, освобождая место.
+
+        VACUUM держит блокировку записи все время работы, поэтому полное сжатие
+        выполняется только из CLI. Заодно база переводится в режим
+        auto_vacuum=INCREMENTAL, в котором фоновая очистка возвращает место по частям.
+        """
+        with closing(self.connect()) as conn:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.execute('VACUUM')
+
+    def compact_incremental(self) -> int:
+        """Возвращает свободные страницы файлу шагами по vacuum_pages, каждый шаг - короткая транзакция."""
+        with closing(self.connect()) as conn:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                logger.warning('В базе не включен auto_vacuum=INCREMENTAL, место не возвращается; '
+                               'выполните python -m src.memory.retention при остановленном боте')
+                return 0
+
+            freed = 0
+
+            while True:
+                free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+                if not free:
+                    break
+
+                # execute выполняет у прагмы только один шаг (одну страницу), executescript - все
+                conn.executescript(f'PRAGMA incremental_vacuum({int(self.policy.vacuum_pages)});')
+                freed += min(free, self.policy.vacuum_pages)
+
+                # Шаг переносится в основной файл сразу, чтобы WAL не разрастался;
+                # PASSIVE не ждет читателей и не блокирует запись
+                conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+                time.sleep(self.policy.vacuum_pause)
+
+            if freed:
+                # Под нагрузкой PASSIVE не успевает сбросить весь WAL; в конце обрезаем его один раз
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+        return freed
+
+    def run(self, full_vacuum: bool = False) -> Dict[str, int]:
+        """Применяет политику; место возвращается по частям или, с full_vacuum, полным VACUUM."""
+        started = time.monotonic()
+        stats = self.prune()
+
+        if self.policy.vacuum and (stats['checkpoints_deleted'] or stats['writes_deleted']):
+            if full_vacuum:
+                self.compact()
+            else:
+                stats['pages_freed'] = self.compact_incremental()
+
+        logger.info('Очистка чекпоинтов за %.1fs: %s', time.monotonic() - started, stats)
+
+        return stats
+
+
+class RetentionWorker(threading.Thread):
+    """Фоновый поток, периодически применяющий политику хранения."""
+
+    def __init__(self, pruner: CheckpointPruner):
+        super().__init__(name='checkpoint-retention', daemon=True)
+        self.pruner = pruner
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.pruner.run()
+            except sqlite3.Error:
+                logger.exception('Не удалось очистить чекпоинты')
+
+            self._stop_event.wait(self.pruner.policy.interval_hours * 3600)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Очистка и сжатие базы чекпоинтов агента')
+    parser.add_argument('--config', default='config/config.yaml', help='Путь к конфигурации (берутся app.sqlite_path и app.retention)')
+    parser.add_argument('--db', help='Путь к базе, переопределяет app.sqlite_path')
+    parser.add_argument('--keep-last', type=int, help='Сколько последних чекпоинтов хранить для каждого треда')
+    parser.add_argument('--max-idle-days', type=float, help='Удалять треды, неактивные дольше указанного числа дней')
+    parser.add_argument('--no-vacuum', action='store_true', help='Не сжимать файл базы после очистки (сжатие полное, бот лучше остановить)')
+    args = parser.parse_args()
+
+    app_config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as file:
+            app_config = yaml.safe_load(file)['app']
+
+    policy = RetentionPolicy.from_config(app_config.get('retention'))
+
+    if args.keep_last is not None:
+        policy.keep_last = args.keep_last
+
+    if args.max_idle_days is not None:
+        policy.max_idle_days = args.max_idle_days
+
+    if args.no_vacuum:
+        policy.vacuum = False
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    CheckpointPruner(args.db or app_config.get('sqlite_path', 'data/memory.sqlite'), policy).run(full_vacuum=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, секунды
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Описания метрик агента для строк HELP
+DESCRIPTIONS = {
+    'agent_node_seconds': 'Время выполнения узлов графа',
+    'agent_actions_total': 'Выполненные действия агента',
+    'agent_llm_seconds': 'Время обращений к LLM',
+    'agent_llm_tokens_total': 'Токены промпта и ответа LLM',
+    'agent_mastodon_seconds': 'Время обращений к API Mastodon',
+    'agent_mastodon_calls_total': 'Обращения к API Mastodon по методам и результату',
+    'agent_outbox_latency_seconds': 'Задержка исходящих действий от постановки в очередь до отправки',
+    'agent_account_lookups_total': 'Поиск id аккаунтов в справочнике: память, база или промах',
+    'agent_listener_seconds': 'Время обработчиков событий стрима',
+    'agent_events_total': 'События стрима по типу и решению',
+    'agent_event_seconds': 'Время обработки события графом',
+    'agent_queue_depth': 'Глубина очереди диспетчера',
+    'agent_rule_hits_total': 'Срабатывания правил быстрого решения',
+    'agent_response_cache_total': 'Обращения к кэшу реакций по результату',
+    'agent_events_shed_total': 'Отброшенные события по типу и причине',
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def label_key(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(labels: Labels, extra: Tuple[str, str] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class MetricsRegistry:
+    """Счетчики, гистограммы и gauge в памяти процесса с выводом в формате Prometheus."""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._gauges: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = label_key(labels)
+
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[label_key(labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = label_key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            # Счетчики по корзинам (последняя - +Inf), затем сумма и количество
+            data = series.get(key)
+            if data is None:
+                data = series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+
+            data[idx] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self) -> str:
+        lines = []
+
+        def header(name: str, kind: str) -> None:
+            help_text = DESCRIPTIONS.get(name, name)
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            for kind, metrics in (('counter', self._counters), ('gauge', self._gauges)):
+                for name, series in sorted(metrics.items()):
+                    header(name, kind)
+                    lines += [f'{name}{format_labels(labels)} {value}' for labels, value in sorted(series.items())]
+
+            for name, series in sorted(self._histograms.items()):
+                header(name, 'histogram')
+
+                for labels, data in sorted(series.items()):
+                    cumulative = 0
+
+                    for bound, count in zip(self.buckets + (float('inf'),), data):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{name}_bucket{format_labels(labels, ("le", le))} {cumulative}')
+
+                    lines.append(f'{name}_sum{format_labels(labels)} {data[-2]}')
+                    lines.append(f'{name}_count{format_labels(labels)} {data[-1]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class NullRegistry:
+    """Реестр-заглушка для выключенных метрик: все операции ничего не делают."""
+
+    _timer = nullcontext()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        pass
+
+    def set(self, name: str, value: float, **labels) -> None:
+        pass
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        pass
+
+    def timer(self, name: str, **labels) -> Any:
+        return self._timer
+
+    def render(self) -> str:
+        return ''
+
+
+registry: Any = NullRegistry()
+
+# Функции модуля - методы текущего реестра; configure перепривязывает их,
+# чтобы выключенные метрики стоили одного пустого вызова
+inc = registry.inc
+set_gauge = registry.set
+observe = registry.observe
+timer = registry.timer
+
+
+def enabled() -> bool:
+    return isinstance(registry, MetricsRegistry)
+
+
+def _bind(new_registry: Any) -> None:
+    global registry, inc, set_gauge, observe, timer
+
+    registry = new_registry
+    inc, set_gauge, observe, timer = new_registry.inc, new_registry.set, new_registry.observe, new_registry.timer
+
+
+def timed(name: str, **labels) -> Callable:
+    """Декоратор, замеряющий время функции.
+
+    Решение принимается при декорировании: если метрики выключены, функция
+    возвращается без обертки, поэтому графы нужно строить после configure.
+    """
+    def decorator(func: Callable) -> Callable:
+        if not enabled():
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with registry.timer(name, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def configure(config: Dict[str, Any] = None) -> Any:
+    """Включает метрики по секции metrics конфигурации и запускает HTTP-эндпоинт /metrics."""
+    config = config or {}
+
+    if not config.get('enabled', False):
+        _bind(NullRegistry())
+        return None
+
+    _bind(MetricsRegistry(tuple(config.get('buckets', BUCKETS))))
+
+    server = ThreadingHTTPServer((config.get('host', '127.0.0.1'), config.get('port', 9100)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Метрики доступны на http://%s:%d/metrics', *server.server_address[:2])
+
+    return server
@@ -0,0 +1,92 @@
+"""Память на агента: один процесс с N агентами против отдельного процесса на каждого бота.
+
+Каждый замер выполняется в отдельном интерпретаторе: импортируются те же модули,
+что и в main.py, строятся графы агентов с общим клиентом LLM и общим чекпоинтером.
+Вместо Mastodon используется эмулятор, запросы в сеть не выполняются.
+
+Запуск из папки tests: python agents_memory.py --agents 1 10 30
+"""
+import sys
+
+sys.path.append('..')
+
+import argparse
+import resource
+import subprocess
+
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child(n_agents: int) -> None:
+    import gc
+    from langgraph.checkpoint.sqlite import SqliteSaver
+    from main import shared_clients
+    from src.graph.logic_graph import build_graph
+    from src.mastodon.dispatcher import EventDispatcher
+    from src.mastodon.listener import BotStreamListener
+    from src.mastodon.outbox import Outbox
+    from src.mastodon.accounts import AccountDirectory
+    from src.mastodon.event_log import ProcessedIndex
+    from src.models.user_profile import UserProfile
+    from mastodon_emulation import MastodonEmulator
+
+    config = {'app': {}, 'llm': {'model': 'gpt-4o-mini', 'api_key': 'sk-none'}}
+
+    llm, _ = shared_clients(config)
+    agents = []
+
+    with SqliteSaver.from_conn_string(':memory:') as memory:
+        dispatcher = EventDispatcher()
+
+        for n in range(n_agents):
+            profile = UserProfile(interests=['технологии', 'ИИ', 'игры'], style='неформальный', nick=f'bot{n}')
+            mastodon = MastodonEmulator()
+            outbox = Outbox(mastodon)
+            accounts = AccountDirectory(mastodon, ':memory:', namespace=profile.nick)
+            graph = build_graph(profile, outbox, memory, config['llm'], accounts=accounts, llm=llm)
+            processed = ProcessedIndex(':memory:', namespace=profile.nick)
+
+            agents.append(BotStreamListener(dispatcher, profile, mastodon, accounts=accounts, processed=processed,
+                                            graph=graph, namespace=profile.nick))
+
+        gc.collect()
+        print(f'{rss_mb():.1f}')
+
+
+def measure(n_agents: int) -> float:
+    out = subprocess.run([sys.executable, __file__, '--child', str(n_agents)], capture_output=True, text=True, check=True)
+
+    return float(out.stdout.split()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--agents', type=int, nargs='+', default=[1, 10, 30])
+    parser.add_argument('--child', type=int)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child)
+
+    single = measure(1)
+    print(f'Один бот в отдельном процессе: {single:.1f} MB\n')
+    print(f'{"агентов":>8} {"процесс, MB":>12} {"на агента, MB":>14} {"контейнеры, MB":>15}')
+
+    for n in args.agents:
+        total = measure(n)
+        print(f'{n:>8} {total:>12.1f} {total / n:>14.1f} {single * n:>15.1f}')
+
+
+if __name__ == '__main__':
+    main()
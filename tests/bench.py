@@ -1,26 +1,64 @@
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Tuple, Any
+from uuid import UUID
 import pandas as pd
-from pydantic import BaseModel, Field
+from langchain_core.callbacks import BaseCallbackHandler
 from mastodon_emulation import MastodonEmulator, typed_to_enum, StatusPost
+from judge import Judge
+from src.memory.compact import decode_history
+from src.llm.replay import LLMCacheMiss
 from dataclasses import asdict
 
 
-class EvaluationResult(BaseModel):
-    relevance: int = Field(description="Оценка релевантности (балл 0-5)")
-    style: int = Field(description="Оценка соответствия стилю (балл 0-5)")
-    plausibility: int = Field(description="Оценка правдоподобности (балл 0-5)")
+# Цены за 1M токенов (USD) для колонки стоимости
+DEFAULT_PRICES = {'prompt': 0.15, 'completion': 0.6}
+
+
+class NodeTimer(BaseCallbackHandler):
+    """Суммарное время выполнения каждого узла графа за один вызов."""
+
+    def __init__(self):
+        self.times: Dict[str, float] = {}
+        self._started: Dict[UUID, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def on_chain_start(self, serialized: Any, inputs: Any, *, run_id: UUID, metadata: Dict = None, name: str = None, **kwargs) -> None:
+        node = (metadata or {}).get('langgraph_node')
+
+        # Внутри узла стартуют и вложенные цепочки (LLM, парсеры) - их время уже входит в узел
+        if node is not None and name == node:
+            with self._lock:
+                self._started[run_id] = (node, time.perf_counter())
+
+    def _finish(self, run_id: UUID) -> None:
+        with self._lock:
+            started = self._started.pop(run_id, None)
+
+            if started:
+                node, start = started
+                self.times[node] = round(self.times.get(node, 0.0) + time.perf_counter() - start, 4)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs) -> None:
+        self._finish(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        self._finish(run_id)
 
 
 class MastodonBenchmark:
-    def __init__(self, graph, profile, mastodon, llm):
+    def __init__(self, graph, profile, mastodon, llm, judge_batch_size: int = 8, judge_cache: str = 'results/judge_cache.sqlite', prices: Dict[str, float] = None):
         self.graph = graph
         self.profile = profile
         self.cases = []
         self.result_scores = []
         self.res_log = []
         self.mastodon = mastodon
-        self.evaluator = llm  # Модель для LLM as a Judge
+        self.judge = Judge(llm, profile, batch_size=judge_batch_size, cache_path=judge_cache)  # LLM as a Judge
+        self.prices = prices or DEFAULT_PRICES
 
     def load_bench(self, path: str) -> None:
         with open(path, 'r', encoding='utf-8') as f:
@@ -32,11 +70,11 @@ class MastodonBenchmark:
                     'outputs': [typed_to_enum(i) for i in case['outputs']]
                 })
 
-    def simulate_notification(self, user: str, content: str, post_id: int) -> Dict:
+    def simulate_notification(self, user: str, content: str, post_id: int, callbacks: List = None) -> Dict:
         """Эмулирует упоминание от пользователя."""
 
         state = {
-            'profile': self.profile,
+            'profile_id': self.profile.nick,
             'context': {
                 'text': content,
                 'post_id': post_id,
@@ -45,15 +83,15 @@ class MastodonBenchmark:
             }
         }
 
-        config = {"configurable": {"thread_id": user}, "recursion_limit": 8}
+        config = {"configurable": {"thread_id": user}, "callbacks": callbacks}
 
         return self.graph.invoke(state, config=config)
 
-    def simulate_update(self, user: str, content: str, post_id: int) -> Dict:
+    def simulate_update(self, user: str, content: str, post_id: int, callbacks: List = None) -> Dict:
         """Эмулирует упоминание от пользователя."""
 
         state = {
-            'profile': self.profile,
+            'profile_id': self.profile.nick,
             'context': {
                 'text': content,
                 'post_id': post_id,
@@ -62,95 +100,165 @@ class MastodonBenchmark:
             }
         }
 
-        config = {"configurable": {"thread_id": user}, "recursion_limit": 8}
+        config = {"configurable": {"thread_id": user}, "callbacks": callbacks}
 
         return self.graph.invoke(state, config=config)
 
-    def evaluate_text_output(self, history: List, gold_text: str, output_text: str) -> EvaluationResult:
-        """Оценивает текстовый вывод с помощью LLM as a Judge."""
+    def score(self, state: Any, gold: List, real: List) -> Tuple[List, List[Dict]]:
+        """Оценки действий кейса; тексты откладываются для пакетной оценки судьей.
 
-        prompt = f"""
-        Оцени следующий ответ агента по трем критериям: релевантность, соответствие стилю и правдоподобность.
-        История диалога: {history}
-        Эталонный ответ: {gold_text}
-        Ответ агента: {output_text}
-        Профиль агента: {self.profile}
+        Возвращает список оценок (None на месте текстов) и элементы для судьи с номером слота.
         """
-        result = self.evaluator.with_structured_output(EvaluationResult).invoke(prompt)
-        print(f'Оценка LLM:\n{result}\n')
-
-        return (result.relevance + result.style + result.plausibility) / 3
-
-    def score(self, state: Any, gold: List, real: List) -> float:
         n_text = 0
 
         real_texts = [a for a in real if str(a).startswith('StatusPost')]
 
-        scores = []
+        scores, judge_items = [], []
 
         if not state.get('chat_history'):
             state['chat_history'] = []
 
         if not gold and real:
-            return 0
+            return [0], []
 
         if not gold and not real:
-            return 5
+            return [5], []
 
         for action in gold:
             if str(action).startswith('StatusPost') and real_texts:
                 real_text = real_texts[n_text]
-                score = self.evaluate_text_output(history=state['chat_history'], gold_text=action.content, output_text=real_text.content)
-                scores.append(score)
+                judge_items.append({'slot': len(scores), 'history': str(decode_history(state['chat_history'])), 'gold': action.content, 'output': real_text.content})
+                scores.append(None)
                 n_text += 1
 
             else:
                 scores.append(5 if str(action) in str(real) else 0)
 
-        return round(sum(scores) / len(scores), 2)
-
-    def run(self) -> Dict:
-        """Запускает бенчмарк для списка тестов."""
-
-        for num, case in enumerate(self.cases):
-            print('='*50 + '\n')
-            print(f'Запускаю тест {num+1} / {len(self.cases)}:' + '\n')
-
-            input_ = case['input_signal']
-            print(f'Вводные:\n{input_}' + '\n')
+        return scores, judge_items
 
-            print(f'Эталонный ответ:\n{case["outputs"]}' + '\n')
-
-            state = {}
+    def run_case(self, num: int, case: Dict) -> Dict:
+        """Прогоняет один кейс в изолированном журнале действий эмулятора и оценивает результат."""
+        input_ = case['input_signal']
+        state = {}
+        timer = NodeTimer()
+        start = time.perf_counter()
 
+        with self.mastodon.isolate() as results:
             try:
                 if input_['type'] == 'notification':
-                    state = self.simulate_notification(**input_['args'])
+                    state = self.simulate_notification(**input_['args'], callbacks=[timer])
 
                 if input_['type'] == 'update':
-                    state = self.simulate_update(**input_['args'])
+                    state = self.simulate_update(**input_['args'], callbacks=[timer])
+
+            except LLMCacheMiss:
+                # При on_miss: fail прогон прерывается, иначе кейс молча засчитался бы пустым
+                raise
 
             except:
                 # import traceback
                 # traceback.print_exc()
                 pass
 
-            results = self.mastodon.iteration_memory
-            self.mastodon.step()
+        latency = round(time.perf_counter() - start, 4)
+        usage = state.get('usage', {})
+        prompt_tokens, completion_tokens = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+        cost = (prompt_tokens * self.prices['prompt'] + completion_tokens * self.prices['completion']) / 1e6
+
+        scores, judge_items = self.score(state=state, gold=case['outputs'], real=results)
+
+        print('=' * 50 + '\n\n' +
+              f'Тест {num + 1} / {len(self.cases)}:\n\n' +
+              f'Вводные:\n{input_}\n\n' +
+              f'Эталонный ответ:\n{case["outputs"]}\n\n' +
+              f'Фактический ответ:\n{results}\n')
 
-            print(f'Фактический ответ:\n{results}' + '\n')
-            self.result_scores.append(self.score(state=state, gold=case['outputs'], real=results))
+        return {'input_signal': input_, 'gold_outputs': [asdict(r) for r in case['outputs']], 'real_outputs': [asdict(r) for r in results],
+                'scores': scores, 'judge_items': judge_items, 'latency': latency, 'node_time': timer.times,
+                'rule': state.get('rule'), 'llm_calls': state.get('llm_calls', 0), 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'cost': round(cost, 6), 'api_calls': sum(results.api_calls.values())}
 
-            print(f'Итоговая оценка за кейс: {self.result_scores[-1]}' + '\n')
+    def judge_cases(self, entries: List[Dict]) -> None:
+        """Оценивает тексты всех кейсов пачками и выставляет итоговые оценки кейсов."""
+        items = [item for entry in entries for item in entry['judge_items']]
+        results = iter(self.judge.scores(items))
 
-            self.res_log.append({'input_signal': input_, 'gold_outputs': [asdict(r) for r in case['outputs']], 'real_outputs': [asdict(r) for r in results], 'score': self.result_scores[-1]})
+        for num, entry in enumerate(entries):
+            scores = list(entry.pop('scores'))
+
+            for item in entry.pop('judge_items'):
+                scores[item['slot']] = next(results)
+
+            entry['score'] = round(sum(scores) / len(scores), 2)
+            print(f'Итоговая оценка за кейс {num + 1}: {entry["score"]}')
+
+    def run(self, concurrency: int = 1, progress_path: str = 'results/bench_progress.jsonl', resume: bool = False, results_path: str = 'results/bench_res') -> Dict:
+        """Запускает бенчмарк для списка тестов.
+
+        Кейсы одного пользователя (один thread_id) выполняются по порядку, кейсы разных
+        пользователей - параллельно в concurrency потоках. Результат каждого кейса
+        дописывается в progress_path, и при resume=True выполненные кейсы пропускаются.
+        Тексты оцениваются судьей после прогона всех кейсов. Итог пишется в results_path + .json/.csv.
+        """
+
+        done = {}
+
+        if resume and os.path.exists(progress_path):
+            with open(progress_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    done[entry.pop('num')] = entry
+
+            print(f'Продолжаю прогон: выполнено {len(done)} / {len(self.cases)} кейсов\n')
+
+        elif os.path.exists(progress_path):
+            os.remove(progress_path)
+
+        chains = {}
+        for num, case in enumerate(self.cases):
+            chains.setdefault(case['input_signal']['args']['user'], []).append(num)
+
+        lock = threading.Lock()
+
+        def run_chain(nums: List[int]) -> None:
+            for num in nums:
+                if num in done:
+                    continue
+
+                entry = self.run_case(num, self.cases[num])
+
+                with lock:
+                    done[num] = entry
+                    with open(progress_path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps({'num': num, **entry}, ensure_ascii=False) + '\n')
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(run_chain, nums) for nums in chains.values()]:
+                future.result()
+
+        self.res_log = [done[num] for num in range(len(self.cases))]
+        self.judge_cases(self.res_log)
+        self.result_scores = [entry['score'] for entry in self.res_log]
 
         final_mark = sum(self.result_scores) / len(self.result_scores)
+        totals = {key: round(sum(entry[key] for entry in self.res_log), 6)
+                  for key in ('latency', 'llm_calls', 'prompt_tokens', 'completion_tokens', 'cost', 'api_calls')}
+
         print('\n' * 2 + '=' * 50 + '\n' * 2)
         print(f'Итоговая оценка за бенчмарк: {final_mark}')
+        print(f'Время {totals["latency"]:.2f} с, вызовов LLM {totals["llm_calls"]}, токены {totals["prompt_tokens"]} / {totals["completion_tokens"]}, '
+              f'стоимость ${totals["cost"]:.4f}, обращений к API Mastodon {totals["api_calls"]}')
+
+        judge_stats = self.judge.snapshot()
+        print(f'Судья: {judge_stats["calls"]} вызовов, токены {judge_stats["input_tokens"]} / {judge_stats["output_tokens"]} (вход / выход), '
+              f'оценено {judge_stats["judged"]}, из кэша {judge_stats["cache_hits"]}')
 
-        with open('results/bench_res.json', 'w', encoding='utf-8') as f:
+        with open(f'{results_path}.json', 'w', encoding='utf-8') as f:
             json.dump(self.res_log, f, ensure_ascii=False, indent=2)
 
-        pd.DataFrame(self.res_log).to_csv('results/bench_res.csv', index=False)
+        # Время узлов в CSV раскладывается по отдельным колонкам
+        rows = [{**{k: v for k, v in entry.items() if k != 'node_time'}, **{f'time_{node}': t for node, t in entry['node_time'].items()}}
+                for entry in self.res_log]
+        pd.DataFrame(rows).to_csv(f'{results_path}.csv', index=False)
 
+        return {'score': final_mark, **totals, 'judge': judge_stats}
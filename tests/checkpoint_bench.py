@@ -0,0 +1,106 @@
+"""Замер задержек чтения/записи чекпоинтов в зависимости от размера базы.
+
+Граф без LLM повторяет запись состояния, как это делает агент: на каждое событие
+в историю добавляются реплики, и все состояние сохраняется в SqliteSaver.
+После наполнения к базе применяется политика хранения и замер повторяется.
+
+Запуск из папки tests: python checkpoint_bench.py --threads 50 --rounds 8 --keep-last 20
+"""
+import sys
+
+sys.path.append('..')
+
+import argparse
+import os
+import random
+import time
+from typing import Dict, List, Any
+from typing_extensions import TypedDict
+from langgraph.graph import StateGraph, END
+from langgraph.checkpoint.sqlite import SqliteSaver
+from src.memory.retention import RetentionPolicy, CheckpointPruner
+
+
+class BenchState(TypedDict):
+    context: Dict[str, Any]
+    chat_history: List[Dict[str, str]]
+
+
+def build_bench_graph(checkpointer: Any):
+    def remember(state: BenchState) -> BenchState:
+        history = state.get('chat_history') or []
+        text = state['context']['text']
+
+        state['chat_history'] = history + [
+            {'role': 'user', 'content': f'Пользователь {state["context"]["user"]} написал пост: {text}'},
+            {'role': 'system', 'content': f'Ты ответил пользователю: {text[::-1]}'},
+        ]
+
+        return state
+
+    graph = StateGraph(BenchState)
+    graph.add_node('remember', remember)
+    graph.set_entry_point('remember')
+    graph.add_edge('remember', END)
+
+    return graph.compile(checkpointer=checkpointer)
+
+
+def db_size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def measure(graph: Any, threads: int, samples: int = 50) -> Dict[str, float]:
+    writes, reads = [], []
+
+    for _ in range(samples):
+        config = {'configurable': {'thread_id': f'user{random.randrange(threads)}'}}
+
+        started = time.perf_counter()
+        graph.invoke({'context': {'user': 'bench', 'text': 'замер ' * 30}}, config=config)
+        writes.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        graph.get_state(config)
+        reads.append(time.perf_counter() - started)
+
+    return {'write_ms': 1000 * sum(writes) / samples, 'read_ms': 1000 * sum(reads) / samples}
+
+
+def report(label: str, path: str, graph: Any, threads: int) -> None:
+    result = measure(graph, threads)
+    print(f'{label:<24} {db_size(path) / 2**20:>9.1f} MB {result["write_ms"]:>10.2f} ms {result["read_ms"]:>10.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='../data/checkpoint_bench.sqlite')
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=8)
+    parser.add_argument('--events-per-round', type=int, default=1000)
+    parser.add_argument('--keep-last', type=int, default=20)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(args.db), exist_ok=True)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+
+    print(f'{"":<24} {"размер БД":>12} {"запись":>13} {"чтение":>13}')
+
+    with SqliteSaver.from_conn_string(args.db) as memory:
+        graph = build_bench_graph(memory)
+
+        for n in range(args.rounds):
+            for i in range(args.events_per_round):
+                config = {'configurable': {'thread_id': f'user{i % args.threads}'}}
+                graph.invoke({'context': {'user': f'user{i % args.threads}', 'text': 'пост ' * 30}}, config=config)
+
+            report(f'{(n + 1) * args.events_per_round} событий', args.db, graph, args.threads)
+
+        CheckpointPruner(args.db, RetentionPolicy(keep_last=args.keep_last)).run(full_vacuum=True)
+        report(f'после keep_last={args.keep_last}', args.db, graph, args.threads)
+
+
+if __name__ == '__main__':
+    main()
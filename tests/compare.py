@@ -0,0 +1,100 @@
+"""Сравнение двух прогонов бенчмарка и поиск регрессий.
+
+Сравниваются суммарные время, токены и средняя оценка, а также каждый кейс
+(кейсы сопоставляются по порядку). Регрессией считается рост времени или токенов
+больше чем на заданную долю либо падение оценки больше заданного числа баллов.
+При регрессиях скрипт завершается с кодом 1.
+
+Запуск из папки tests: python compare.py results/base_res.json results/bench_res.json --latency 0.2 --tokens 0.1 --score 0.3
+"""
+import argparse
+import json
+import sys
+from typing import Dict, List
+
+
+METRICS = ('latency', 'prompt_tokens', 'completion_tokens', 'llm_calls', 'api_calls', 'cost')
+
+
+def load(path: str) -> List[Dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def totals(res: List[Dict]) -> Dict[str, float]:
+    result = {key: sum(entry.get(key, 0) for entry in res) for key in METRICS}
+    result['score'] = sum(entry['score'] for entry in res) / len(res)
+
+    return result
+
+
+def growth(old: float, new: float) -> float:
+    if old == 0:
+        return 0.0 if new == 0 else float('inf')
+
+    return (new - old) / old
+
+
+def regressions(old: Dict, new: Dict, latency: float, tokens: float, score: float) -> List[str]:
+    found = []
+
+    if growth(old['latency'], new['latency']) > latency:
+        found.append(f'время {old["latency"]:.2f} -> {new["latency"]:.2f} с')
+
+    old_tokens = old['prompt_tokens'] + old['completion_tokens']
+    new_tokens = new['prompt_tokens'] + new['completion_tokens']
+
+    if growth(old_tokens, new_tokens) > tokens:
+        found.append(f'токены {old_tokens} -> {new_tokens}')
+
+    if old['score'] - new['score'] > score:
+        found.append(f'оценка {old["score"]:.2f} -> {new["score"]:.2f}')
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('base', help='Эталонный прогон (bench_res.json)')
+    parser.add_argument('new', help='Новый прогон')
+    parser.add_argument('--latency', type=float, default=0.2, help='Допустимый рост времени (доля)')
+    parser.add_argument('--tokens', type=float, default=0.1, help='Допустимый рост токенов (доля)')
+    parser.add_argument('--score', type=float, default=0.3, help='Допустимое падение оценки (баллы)')
+    parser.add_argument('--min-latency', type=float, default=0.05, help='Кейсы быстрее этого времени (с) не проверяются по времени')
+    args = parser.parse_args()
+
+    base, new = load(args.base), load(args.new)
+
+    if len(base) != len(new):
+        print(f'Разное число кейсов: {len(base)} и {len(new)}, сравниваются первые {min(len(base), len(new))}')
+
+    base_totals, new_totals = totals(base), totals(new)
+
+    print(f'{"метрика":>18} {"было":>12} {"стало":>12} {"изменение":>10}')
+    for key in METRICS + ('score',):
+        change = growth(base_totals[key], new_totals[key])
+        print(f'{key:>18} {base_totals[key]:>12.4g} {new_totals[key]:>12.4g} {change:>+10.1%}')
+
+    found = [f'итого: {r}' for r in regressions(base_totals, new_totals, args.latency, args.tokens, args.score)]
+
+    for num, (old, cur) in enumerate(zip(base, new)):
+        if old['input_signal'] != cur['input_signal']:
+            print(f'Кейс {num + 1}: вводные отличаются, кейс пропущен')
+            continue
+
+        # На очень быстрых кейсах относительный рост времени - шум
+        latency = args.latency if max(old.get('latency', 0), cur.get('latency', 0)) >= args.min_latency else float('inf')
+        found += [f'кейс {num + 1}: {r}' for r in regressions({**dict.fromkeys(METRICS, 0), **old}, {**dict.fromkeys(METRICS, 0), **cur}, latency, args.tokens, args.score)]
+
+    if found:
+        print('\nРегрессии:')
+        for line in found:
+            print(f'  {line}')
+
+        sys.exit(1)
+
+    print('\nРегрессий нет')
+
+
+if __name__ == '__main__':
+    main()
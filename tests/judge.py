@@ -0,0 +1,137 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, Field
+
+
+class EvaluationResult(BaseModel):
+    relevance: int = Field(description="Оценка релевантности (балл 0-5)")
+    style: int = Field(description="Оценка соответствия стилю (балл 0-5)")
+    plausibility: int = Field(description="Оценка правдоподобности (балл 0-5)")
+
+
+class ItemEvaluation(EvaluationResult):
+    index: int = Field(description="Номер оцениваемого ответа")
+
+
+class BatchEvaluation(BaseModel):
+    evaluations: List[ItemEvaluation] = Field(description="Оценки всех ответов, по одной на каждый номер")
+
+
+def item_key(model: str, profile: str, item: Dict[str, str]) -> str:
+    payload = {'model': model, 'profile': profile, 'history': item['history'], 'gold': item['gold'], 'output': item['output']}
+
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class JudgeCache:
+    """Оценки судьи, сохраненные по хэшу входных данных и модели судьи."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS judge_scores (key TEXT PRIMARY KEY, relevance INTEGER, style INTEGER, plausibility INTEGER)')
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[EvaluationResult]:
+        with self._lock:
+            row = self._conn.execute('SELECT relevance, style, plausibility FROM judge_scores WHERE key = ?', (key,)).fetchone()
+
+        return EvaluationResult(relevance=row[0], style=row[1], plausibility=row[2]) if row else None
+
+    def put(self, key: str, result: EvaluationResult) -> None:
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO judge_scores VALUES (?, ?, ?, ?)', (key, result.relevance, result.style, result.plausibility))
+            self._conn.commit()
+
+
+class Judge:
+    """LLM as a Judge, оценивающий ответы агента пачками.
+
+    Элемент оценки - словарь с ключами history, gold и output. В один вызов уходит
+    до batch_size элементов, профиль агента и одинаковые истории передаются один раз.
+    Оценки кэшируются, повторный прогон не оценивает неизменные пары заново.
+    """
+
+    def __init__(self, llm: Any, profile: Any, batch_size: int = 8, cache_path: str = 'results/judge_cache.sqlite'):
+        self.llm = llm
+        self.profile = str(profile)
+        self.model = getattr(llm, 'model_name', None) or getattr(llm, 'model', '')
+        self.batch_size = batch_size
+        self.cache = JudgeCache(cache_path)
+
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_hits = 0
+        self.judged = 0
+
+    def prompt(self, items: List[Dict[str, str]]) -> str:
+        histories = list(dict.fromkeys(item['history'] for item in items))
+
+        blocks = [f'История {n}: {history}' for n, history in enumerate(histories)]
+        blocks += [
+            f'Ответ {n} (история {histories.index(item["history"])}):\n'
+            f'Эталонный ответ: {item["gold"]}\n'
+            f'Ответ агента: {item["output"]}'
+            for n, item in enumerate(items)
+        ]
+
+        return (
+            'Оцени каждый ответ агента по трем критериям: релевантность, соответствие стилю и правдоподобность.\n'
+            f'Профиль агента: {self.profile}\n\n' + '\n\n'.join(blocks)
+        )
+
+    def _evaluate(self, items: List[Dict[str, str]]) -> Dict[int, EvaluationResult]:
+        result = self.llm.with_structured_output(BatchEvaluation, include_raw=True).invoke(self.prompt(items))
+
+        self.calls += 1
+        usage = result['raw'].usage_metadata or {}
+        self.input_tokens += usage.get('input_tokens', 0)
+        self.output_tokens += usage.get('output_tokens', 0)
+
+        if result['parsing_error'] is not None:
+            raise result['parsing_error']
+
+        return {e.index: EvaluationResult(**e.model_dump(exclude={'index'})) for e in result['parsed'].evaluations if 0 <= e.index < len(items)}
+
+    def evaluate(self, items: List[Dict[str, str]]) -> List[EvaluationResult]:
+        keys = [item_key(self.model, self.profile, item) for item in items]
+        results = [self.cache.get(key) for key in keys]
+        self.cache_hits += sum(r is not None for r in results)
+
+        pending = [n for n, r in enumerate(results) if r is None]
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+
+        while batches:
+            batch = batches.pop(0)
+            evaluated = self._evaluate([items[n] for n in batch])
+
+            for i, n in enumerate(batch):
+                if i in evaluated:
+                    results[n] = evaluated[i]
+                    self.cache.put(keys[n], evaluated[i])
+                    self.judged += 1
+
+                elif len(batch) > 1:
+                    # Пропущенный в ответе элемент оценивается отдельным вызовом
+                    batches.append([n])
+
+                else:
+                    raise ValueError(f'Судья не вернул оценку для ответа {items[n]["output"]!r}')
+
+        return results
+
+    def scores(self, items: List[Dict[str, str]]) -> List[float]:
+        return [(r.relevance + r.style + r.plausibility) / 3 for r in self.evaluate(items)]
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            'calls': self.calls,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens,
+            'cache_hits': self.cache_hits,
+            'judged': self.judged,
+        }
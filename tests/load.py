@@ -0,0 +1,329 @@
+"""Нагрузочный прогон: сколько событий стрима в секунду выдерживает один бот.
+
+Генератор вызывает BotStreamListener.on_update/on_notification синтетическими
+статусами и упоминаниями с заданной частотой (пуассоновский поток), авторы
+выбираются по закону Ципфа: немногие пользователи пишут большую часть постов.
+События проходят весь путь бота: индекс обработанных, диспетчер, граф и
+чекпоинтер SQLite. Вместо LLM по умолчанию используется заглушка с фиксированной
+задержкой, вместо Mastodon - эмулятор.
+
+Для каждой частоты печатаются пропускная способность, перцентили сквозной
+задержки (от вызова listener до завершения обработки), рост очереди и базы.
+Частота выдерживается, если очередь не растет, а отброшенных событий нет.
+
+Запуск из папки tests: python load.py --rates 5 10 20 --duration 30 --users 200 --llm-latency 0.3
+"""
+import sys
+
+sys.path.append('..')
+
+import argparse
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, List
+from langchain_core.messages import AIMessage
+from langgraph.checkpoint.sqlite import SqliteSaver
+from main import load_config
+from src.graph.logic_graph import build_graph
+from src.graph.rules import RuleEngine
+from src.graph.response_cache import ResponseCache
+from src.mastodon.dispatcher import EventDispatcher, percentile
+from src.mastodon.event_log import ProcessedIndex
+from src.mastodon.listener import BotStreamListener
+from src.models.user_profile import UserProfile
+from mastodon_emulation import MastodonEmulator
+
+
+TOPICS = ['нейросети', 'ИИ', 'программирование', 'игры', 'космос', 'футбол', 'кулинария', 'погода', 'музыка', 'наука']
+PHRASES = [
+    'Что думаете про {topic}?',
+    'Сегодня весь день разбирался с темой {topic}, делюсь впечатлениями',
+    'Новость дня: {topic} снова в центре внимания',
+    'Кто-нибудь может посоветовать что почитать про {topic}?',
+    'Мой вечер: чай и {topic}',
+]
+
+
+class StubLLM:
+    """Заглушка LLM с фиксированной задержкой ответа.
+
+    На упоминание отвечает, пост ленты лайкает; после выполненного действия выбирает pass.
+    Если схема ограничена правилами, берется первое разрешенное действие.
+    """
+
+    def __init__(self, latency: float = 0.3):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _content(message: Any) -> str:
+        return message['content'] if isinstance(message, dict) else message.content
+
+    def _usage(self, messages: List[Any], output: int) -> Dict[str, int]:
+        prompt = sum(len(self._content(m)) for m in messages) // 4
+        return {'input_tokens': prompt, 'output_tokens': output, 'total_tokens': prompt + output}
+
+    def _wait(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+        time.sleep(self.latency)
+
+    def _choose(self, messages: List[Any]) -> str:
+        last = self._content(messages[-2]) if len(messages) > 1 else ''
+
+        if last.startswith('Ты '):
+            return 'pass'
+
+        return 'reply' if 'написал тебе сообщение' in last else 'like'
+
+    def invoke(self, messages: List[Any]) -> AIMessage:
+        self._wait()
+        return AIMessage(content='Согласен, интересная тема!', usage_metadata=self._usage(messages, 8))
+
+    def with_structured_output(self, schema: Any, include_raw: bool = False) -> Any:
+        stub = self
+
+        class Structured:
+            def invoke(self, messages: List[Any]) -> Any:
+                stub._wait()
+                action = stub._choose(messages)
+
+                if 'actions' in schema.model_fields:
+                    step = schema.model_fields['actions'].annotation.__args__[0]
+                    allowed = step.model_fields['action'].annotation.__args__
+                    steps = [] if action == 'pass' else [{'action': action if action in allowed else allowed[0]}]
+                    parsed = schema.model_validate({'actions': steps})
+
+                else:
+                    allowed = schema.model_fields['action'].annotation.__args__
+                    parsed = schema.model_validate({'action': action if action in allowed else allowed[-1]})
+
+                raw = AIMessage(content='', usage_metadata=stub._usage(messages, 5))
+
+                return {'raw': raw, 'parsed': parsed, 'parsing_error': None} if include_raw else parsed
+
+        return Structured()
+
+
+class LatencyIndex(ProcessedIndex):
+    """Индекс обработанных событий, замеряющий время от приема события до завершения обработки."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started: Dict[str, float] = {}
+        self.latencies: Dict[str, List[float]] = {'status': [], 'notification': []}
+        self._timing_lock = threading.Lock()
+
+    def claim(self, kind: str, event_id: Any) -> bool:
+        with self._timing_lock:
+            self.started[f'{kind}:{event_id}'] = time.perf_counter()
+
+        return super().claim(kind, event_id)
+
+    def complete(self, kind: str, event_id: Any) -> None:
+        super().complete(kind, event_id)
+
+        with self._timing_lock:
+            started = self.started.pop(f'{kind}:{event_id}', None)
+
+            if started is not None:
+                self.latencies[kind].append(time.perf_counter() - started)
+
+    def completed(self) -> int:
+        with self._timing_lock:
+            return sum(len(values) for values in self.latencies.values())
+
+
+class EventGenerator:
+    """Синтетические статусы и упоминания; авторы распределены по закону Ципфа с показателем zipf."""
+
+    def __init__(self, nick: str, users: int = 200, zipf: float = 1.1, mention_share: float = 0.2, seed: int = 0):
+        self.nick = nick
+        self.mention_share = mention_share
+        self.random = random.Random(seed)
+        self.users = [f'user{n}' for n in range(users)]
+        self.weights = list(itertools.accumulate(1 / (rank ** zipf) for rank in range(1, users + 1)))
+        self._ids = itertools.count(1)
+
+    def _text(self) -> str:
+        phrase = self.random.choice(PHRASES).format(topic=self.random.choice(TOPICS))
+        return f'{phrase} #{self.random.randrange(1000)}'
+
+    def _status(self, user: str, content: str, mentions: List[Dict] = ()) -> Dict[str, Any]:
+        return {
+            'id': str(next(self._ids)),
+            'content': f'<p>{content}</p>',
+            'account': {'id': user, 'username': user, 'acct': user},
+            'in_reply_to_id': None,
+            'mentions': list(mentions),
+            'tags': [],
+        }
+
+    def next(self) -> Any:
+        """Следующее событие: ('update', статус) или ('notification', уведомление)."""
+        user = self.random.choices(self.users, cum_weights=self.weights)[0]
+
+        if self.random.random() >= self.mention_share:
+            return 'update', self._status(user, self._text())
+
+        mention = f'<span class="h-card"><a href="https://example.org/@{self.nick}" class="u-url mention">@<span>{self.nick}</span></a></span> '
+        status = self._status(user, mention + self._text(), [{'id': self.nick, 'username': self.nick, 'acct': self.nick}])
+
+        return 'notification', {'id': str(next(self._ids)), 'type': 'mention', 'account': status['account'], 'status': status}
+
+
+def db_size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def run_load(args: Any, config: Dict[str, Any], rate: float, llm: Any) -> Dict[str, Any]:
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+
+    profile = UserProfile(**config['user_profile']) if 'user_profile' in config else \
+        UserProfile(interests=['ИИ', 'программирование', 'наука'], style='дружелюбный', nick='tcar')
+
+    dispatcher_config = dict(config.get('dispatcher', {}))
+    dispatcher_config.update({k: v for k, v in (('workers', args.workers), ('max_queue', args.max_queue)) if v is not None})
+    dispatcher_config['stats_interval'] = float('inf')
+
+    with SqliteSaver.from_conn_string(args.db) as memory:
+        mastodon = MastodonEmulator()
+        graph = build_graph(
+            profile=profile,
+            mastodon=mastodon,
+            checkpointer=memory,
+            llm_config=config.get('llm', {'model': 'gpt-4o-mini'}),
+            graph_config=config.get('graph'),
+            memory_config=config.get('memory'),
+            llm=llm,
+            rules=RuleEngine.from_config(config.get('rules'), profile.interests),
+            response_cache=ResponseCache.from_config(config.get('response_cache'))
+        )
+
+        dispatcher = EventDispatcher(graph, **dispatcher_config)
+        processed = LatencyIndex(args.db)
+        listener = BotStreamListener(dispatcher, profile, mastodon, processed=processed)
+        generator = EventGenerator(profile.nick, args.users, args.zipf, args.mention_share, args.seed)
+
+        dispatcher.start()
+        start_size = db_size(args.db)
+        samples, generated = [], 0
+        handlers = {'update': listener.on_update, 'notification': listener.on_notification}
+
+        started = time.perf_counter()
+        next_at, next_sample = started, started + args.sample_interval
+
+        while True:
+            now = time.perf_counter()
+
+            if now >= next_sample:
+                samples.append({'time': round(now - started, 1), 'generated': generated, 'completed': processed.completed(),
+                                'queue': dispatcher.stats.queue_depth, 'db_mb': round(db_size(args.db) / 2 ** 20, 2)})
+                next_sample += args.sample_interval
+
+            if now - started >= args.duration:
+                break
+
+            if now < next_at:
+                time.sleep(min(next_at, next_sample) - now)
+                continue
+
+            kind, payload = generator.next()
+            handlers[kind](payload)
+            generated += 1
+            next_at += generator.random.expovariate(rate)
+
+        elapsed = time.perf_counter() - started
+        queue_at_end = dispatcher.stats.queue_depth
+
+        drain_started = time.perf_counter()
+        dispatcher.stop()
+        drain = time.perf_counter() - drain_started
+
+        stats = dispatcher.stats.snapshot()
+        latencies = processed.latencies
+        everything = latencies['status'] + latencies['notification']
+
+        return {
+            'rate': rate,
+            'generated': generated,
+            'offered_rate': round(generated / elapsed, 2),
+            'throughput': round(len(everything) / (elapsed + drain), 2),
+            'p50': percentile(everything, 50),
+            'p95': percentile(everything, 95),
+            'p99': percentile(everything, 99),
+            'mention_p95': percentile(latencies['notification'], 95),
+            'update_p95': percentile(latencies['status'], 95),
+            'queue_at_end': queue_at_end,
+            'max_queue': stats['max_queue_depth'],
+            'queue_growth': round(queue_at_end / elapsed, 2),
+            'drain': round(drain, 2),
+            'shed': stats['shed'],
+            'coalesced': stats['coalesced'],
+            'failed': stats['failed'],
+            'db_growth_mb': round((db_size(args.db) - start_size) / 2 ** 20, 2),
+            'db_bytes_per_event': round((db_size(args.db) - start_size) / max(generated, 1)),
+            'llm_calls': getattr(llm, 'calls', None),
+            'samples': samples,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rates', type=float, nargs='+', default=[5, 10, 20], help='Частоты событий в секунду, каждая прогоняется отдельно')
+    parser.add_argument('--duration', type=float, default=30, help='Длительность генерации на одну частоту, с')
+    parser.add_argument('--users', type=int, default=200, help='Число авторов событий')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Показатель распределения Ципфа по авторам (0 - равномерно)')
+    parser.add_argument('--mention-share', type=float, default=0.2, help='Доля упоминаний среди событий')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='Задержка заглушки LLM, с')
+    parser.add_argument('--real-llm', action='store_true', help='Использовать LLM из конфигурации вместо заглушки')
+    parser.add_argument('--workers', type=int, help='Потоки диспетчера (по умолчанию из конфигурации)')
+    parser.add_argument('--max-queue', type=int, help='Ограничение очереди диспетчера')
+    parser.add_argument('--config', default='../config/config.yaml', help='Конфигурация: секции llm, graph, memory, dispatcher, rules, response_cache')
+    parser.add_argument('--db', default='../data/load.sqlite')
+    parser.add_argument('--sample-interval', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    config = load_config(args.config) if os.path.exists(args.config) else {}
+    os.makedirs(os.path.dirname(args.db), exist_ok=True)
+
+    results = []
+
+    for rate in args.rates:
+        if args.real_llm:
+            from langchain_openai import ChatOpenAI
+            llm = ChatOpenAI(**config['llm'])
+        else:
+            llm = StubLLM(args.llm_latency)
+
+        result = run_load(args, config, rate, llm)
+        results.append(result)
+
+        for sample in result['samples']:
+            print(f'  {sample["time"]:>6.1f} с: событий {sample["generated"]}, обработано {sample["completed"]}, '
+                  f'очередь {sample["queue"]}, база {sample["db_mb"]} MB')
+
+        print(f'{rate:g} соб/с: подано {result["offered_rate"]}/с, обработано {result["throughput"]}/с, '
+              f'задержка p50/p95/p99 {result["p50"]}/{result["p95"]}/{result["p99"]} с '
+              f'(упоминания p95 {result["mention_p95"]}, посты p95 {result["update_p95"]}), '
+              f'очередь {result["queue_at_end"]} (макс {result["max_queue"]}, +{result["queue_growth"]}/с), '
+              f'дообработка {result["drain"]} с, отброшено {result["shed"]}, '
+              f'база +{result["db_growth_mb"]} MB ({result["db_bytes_per_event"]} байт/событие)')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
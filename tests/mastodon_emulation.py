@@ -1,5 +1,8 @@
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional
 
 
 @dataclass
@@ -23,29 +26,67 @@ class AccountUnfollow:
     user_id: str
 
 
+class CaseLog(list):
+    """Действия одного кейса и счетчик обращений к API по методам."""
+
+    def __init__(self):
+        super().__init__()
+        self.api_calls = Counter()
+
+
+# Журнал действий текущего кейса; контекст копируется в потоки, где LangGraph выполняет узлы
+_case_actions: ContextVar[Optional[CaseLog]] = ContextVar('case_actions', default=None)
+
+
 class MastodonEmulator:
     def __init__(self):
         self.memory = []
         self.iteration_memory = []
+        self.api_calls = Counter()
 
     def step(self):
         self.memory.append(self.iteration_memory)
         self.iteration_memory = []
 
+    @contextmanager
+    def isolate(self) -> Iterator[CaseLog]:
+        """Собирает действия, выполненные внутри блока, в отдельный список (для параллельных кейсов)."""
+        actions = CaseLog()
+        token = _case_actions.set(actions)
+
+        try:
+            yield actions
+        finally:
+            _case_actions.reset(token)
+            self.memory.append(actions)
+
+    def _count(self, method: str) -> None:
+        actions = _case_actions.get()
+        (self.api_calls if actions is None else actions.api_calls)[method] += 1
+
+    def _record(self, action: Any) -> None:
+        actions = _case_actions.get()
+        (self.iteration_memory if actions is None else actions).append(action)
+
     def account_search(self, nick, *args, **kwargs) -> List:
+        self._count('account_search')
         return [{'id': nick}]
 
     def status_post(self, content: str, in_reply_to_id: int = None) -> None:
-        self.iteration_memory.append(StatusPost(content=content, in_reply_to_id=in_reply_to_id))
+        self._count('status_post')
+        self._record(StatusPost(content=content, in_reply_to_id=in_reply_to_id))
 
     def status_favourite(self, post_id: int) -> None:
-        self.iteration_memory.append(StatusFavorite(post_id=post_id))
+        self._count('status_favourite')
+        self._record(StatusFavorite(post_id=post_id))
 
     def account_follow(self, user_id: str) ->  None:
-        self.iteration_memory.append(AccountFollow(user_id=user_id))
+        self._count('account_follow')
+        self._record(AccountFollow(user_id=user_id))
 
     def account_unfollow(self, user_id: str) ->  None:
-        self.iteration_memory.append(AccountUnfollow(user_id=user_id))
+        self._count('account_unfollow')
+        self._record(AccountUnfollow(user_id=user_id))
 
 
 def typed_to_enum(inp: Dict) -> Any:
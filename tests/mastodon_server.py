@@ -0,0 +1,583 @@
+"""Локальный HTTP-сервер, заменяющий Mastodon API для настоящего клиента Mastodon.py.
+
+В отличие от MastodonEmulator, через сервер проходит весь путь запроса клиента:
+HTTP, разбор JSON, заголовки лимитов X-RateLimit-* и стриминг (SSE). Сервер
+отвечает на методы, которые использует бот, умеет добавлять задержку, отвечать
+429 и 5xx и отдавать в стрим заранее заданные события. Действия бота пишутся
+в тот же журнал, что и у эмулятора, поэтому сервер подходит для MastodonBenchmark.
+
+Пример:
+    with MastodonServer(latency=0.05, error_rate=0.1) as server:
+        mastodon = server.client()
+        server.push_update(server.make_status('UserA', 'Привет, #ИИ'))
+"""
+import itertools
+import json
+import queue
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+import requests
+from mastodon import Mastodon
+from mastodon_emulation import CaseLog, StatusPost, StatusFavorite, AccountFollow, AccountUnfollow
+
+
+# Заголовок, которым клиент сообщает серверу кейс бенчмарка
+CASE_HEADER = 'X-Bench-Case'
+
+_current_case: ContextVar[Optional[str]] = ContextVar('server_case', default=None)
+
+
+class CaseSession(requests.Session):
+    """HTTP-сессия клиента, помечающая запросы кейсом, в котором они выполнены."""
+
+    def request(self, method, url, *args, headers=None, **kwargs):
+        case = _current_case.get()
+
+        if case is not None:
+            headers = dict(headers or {}, **{CASE_HEADER: case})
+
+        return super().request(method, url, *args, headers=headers, **kwargs)
+
+
+def iso_time(timestamp: float = None) -> str:
+    moment = datetime.fromtimestamp(time.time() if timestamp is None else timestamp, tz=timezone.utc)
+
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def log_id(value: str) -> Any:
+    # В журнале id постов хранятся числами, как в тестах бенчмарка
+    return int(value) if value.isdigit() else value
+
+
+class MastodonServer:
+    """Сервер-заменитель Mastodon API.
+
+    Задержка ответа - latency плюс равномерная случайная добавка до jitter секунд.
+    С вероятностью ratelimit_rate запрос получает 429, с вероятностью error_rate -
+    ответ с кодом из error_codes. Кроме того, сервер ведет честный лимит:
+    ratelimit_limit запросов за ratelimit_window секунд, после чего отвечает 429
+    до сброса окна. Ошибки можно задать и явно через fail_next.
+
+    Журнал действий устроен как у MastodonEmulator: memory, iteration_memory, step
+    и isolate. Для разделения параллельных кейсов клиент должен быть создан
+    методом client: его сессия передает серверу кейс в заголовке. Запросы без кейса
+    (например, из фонового потока Outbox) пишутся в iteration_memory.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, error_codes: Tuple[int, ...] = (500, 502, 503), ratelimit_rate: float = 0.0,
+                 ratelimit_limit: int = 300, ratelimit_window: float = 300.0, heartbeat: float = 15.0,
+                 nick: str = 'tcar', seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.ratelimit_rate = ratelimit_rate
+        self.ratelimit_limit = ratelimit_limit
+        self.ratelimit_window = ratelimit_window
+        self.heartbeat = heartbeat
+        self.nick = nick
+        self.random = random.Random(seed)
+
+        self.memory = []
+        self.iteration_memory = []
+        self.api_calls = Counter()
+        self.injected = Counter()
+
+        self.statuses: Dict[str, Dict] = {}
+        self.timeline: List[Dict] = []
+        self.notifications: List[Dict] = []
+        self.accounts: Dict[str, Dict] = {}
+
+        self._ids = itertools.count(100000)
+        self._cases: Dict[str, CaseLog] = {}
+        self._case_ids = itertools.count(1)
+        self._forced: List[int] = []
+        self._window_start = time.time()
+        self._window_used = 0
+        self._streams: List[queue.Queue] = []
+        self._lock = threading.Lock()
+        self._stream_cond = threading.Condition(self._lock)
+
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+        self.me = self.account(nick)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'MastodonServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mastodon-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.close_streams()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'MastodonServer':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def client(self, **kwargs) -> Mastodon:
+        """Настоящий клиент Mastodon.py, направленный на этот сервер."""
+        params = dict(api_base_url=self.url, access_token='bench-token', version_check_mode='none', ratelimit_method='throw')
+        params.update(kwargs)
+
+        return Mastodon(session=CaseSession(), **params)
+
+    # Журнал действий
+
+    def step(self):
+        self.memory.append(self.iteration_memory)
+        self.iteration_memory = []
+
+    @contextmanager
+    def isolate(self) -> Iterator[CaseLog]:
+        """Собирает действия запросов, выполненных внутри блока, в отдельный список."""
+        actions = CaseLog()
+        case = str(next(self._case_ids))
+
+        with self._lock:
+            self._cases[case] = actions
+
+        token = _current_case.set(case)
+
+        try:
+            yield actions
+        finally:
+            _current_case.reset(token)
+
+            with self._lock:
+                del self._cases[case]
+                self.memory.append(actions)
+
+    def _log(self, case: Optional[str]) -> Tuple[List, Counter]:
+        actions = self._cases.get(case) if case is not None else None
+
+        if actions is None:
+            return self.iteration_memory, self.api_calls
+
+        return actions, actions.api_calls
+
+    # Данные и события
+
+    def account(self, username: str) -> Dict[str, Any]:
+        """Аккаунт по нику; id совпадает с ником, как в журнале эмулятора."""
+        with self._lock:
+            if username not in self.accounts:
+                self.accounts[username] = {
+                    'id': username,
+                    'username': username,
+                    'acct': username,
+                    'display_name': username,
+                    'url': f'{self.url}/@{username}',
+                    'created_at': iso_time(),
+                    'note': '',
+                    'bot': False,
+                    'locked': False,
+                    'followers_count': 0,
+                    'following_count': 0,
+                    'statuses_count': 0,
+                }
+
+            return self.accounts[username]
+
+    def make_status(self, user: str, text: str, mentions: List[str] = None, tags: List[str] = None,
+                    links: List[str] = None, in_reply_to_id: str = None) -> Dict[str, Any]:
+        """Статус в формате API: HTML-содержимое с разметкой упоминаний, хэштегов и ссылок и структурные поля."""
+        mentions = list(mentions or [])
+        tags = list(tags or [])
+        links = list(links or [])
+
+        parts = []
+        for nick in mentions:
+            parts.append(f'<span class="h-card"><a href="{self.url}/@{nick}" class="u-url mention">@<span>{nick}</span></a></span>')
+
+        parts.append(escape(text))
+
+        for tag in tags:
+            parts.append(f'<a href="{self.url}/tags/{tag}" class="mention hashtag" rel="tag">#<span>{tag}</span></a>')
+
+        for link in links:
+            parts.append(f'<a href="{link}" rel="nofollow noopener" target="_blank">{escape(link)}</a>')
+
+        status_id = str(next(self._ids))
+
+        return {
+            'id': status_id,
+            'uri': f'{self.url}/statuses/{status_id}',
+            'url': f'{self.url}/@{user}/{status_id}',
+            'created_at': iso_time(),
+            'account': self.account(user),
+            'content': f'<p>{" ".join(parts)}</p>',
+            'visibility': 'public',
+            'sensitive': False,
+            'spoiler_text': '',
+            'language': 'ru',
+            'in_reply_to_id': in_reply_to_id,
+            'in_reply_to_account_id': None,
+            'reblog': None,
+            'favourited': False,
+            'favourites_count': 0,
+            'reblogs_count': 0,
+            'replies_count': 0,
+            'media_attachments': [],
+            'mentions': [{'id': nick, 'username': nick, 'acct': nick, 'url': f'{self.url}/@{nick}'} for nick in mentions],
+            'tags': [{'name': tag, 'url': f'{self.url}/tags/{tag}'} for tag in tags],
+            'emojis': [],
+        }
+
+    def make_mention(self, user: str, text: str, **kwargs) -> Dict[str, Any]:
+        """Уведомление об упоминании бота пользователем user."""
+        status = self.make_status(user, text, mentions=[self.nick] + list(kwargs.pop('mentions', [])), **kwargs)
+
+        return {'id': str(next(self._ids)), 'type': 'mention', 'created_at': status['created_at'], 'account': status['account'], 'status': status}
+
+    def push_update(self, status: Dict[str, Any]) -> None:
+        """Публикует статус в домашней ленте и отправляет его в открытые стримы."""
+        with self._lock:
+            self.statuses[status['id']] = status
+            self.timeline.append(status)
+
+        self._broadcast('update', status)
+
+    def push_notification(self, notification: Dict[str, Any]) -> None:
+        with self._lock:
+            self.statuses[notification['status']['id']] = notification['status']
+            self.notifications.append(notification)
+
+        self._broadcast('notification', notification)
+
+    def play(self, events: List[Tuple[str, Dict[str, Any]]], interval: float = 0.0) -> threading.Thread:
+        """Отдает события ('update' или 'notification', данные) в фоне с паузой interval между ними."""
+        push = {'update': self.push_update, 'notification': self.push_notification}
+
+        def run():
+            for kind, payload in events:
+                push[kind](payload)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name='mastodon-script', daemon=True)
+        thread.start()
+
+        return thread
+
+    def wait_for_stream(self, count: int = 1, timeout: float = 10.0) -> bool:
+        """Ждет, пока к стриму подключатся count клиентов."""
+        with self._stream_cond:
+            return self._stream_cond.wait_for(lambda: len(self._streams) >= count, timeout)
+
+    def close_streams(self) -> None:
+        """Закрывает открытые стримы; клиент увидит обрыв и переподключится."""
+        with self._lock:
+            for stream in self._streams:
+                stream.put(None)
+
+    def _broadcast(self, event: str, payload: Dict[str, Any]) -> None:
+        message = f'event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n'.encode('utf-8')
+
+        with self._lock:
+            for stream in self._streams:
+                stream.put(message)
+
+    def fail_next(self, status: int, count: int = 1) -> None:
+        """Следующие count запросов к API получат ответ с кодом status."""
+        with self._lock:
+            self._forced += [status] * count
+
+    # Лимиты и ошибки
+
+    def _admit(self) -> Tuple[Optional[int], Dict[str, str]]:
+        """Код ошибки для текущего запроса (или None) и заголовки лимита."""
+        with self._lock:
+            now = time.time()
+
+            if now - self._window_start >= self.ratelimit_window:
+                self._window_start, self._window_used = now, 0
+
+            self._window_used += 1
+            remaining = max(self.ratelimit_limit - self._window_used, 0)
+            headers = {
+                'X-RateLimit-Limit': str(self.ratelimit_limit),
+                'X-RateLimit-Remaining': str(remaining),
+                'X-RateLimit-Reset': iso_time(self._window_start + self.ratelimit_window),
+            }
+
+            if self._forced:
+                status = self._forced.pop(0)
+            elif self._window_used > self.ratelimit_limit or self.random.random() < self.ratelimit_rate:
+                status = 429
+            elif self.random.random() < self.error_rate:
+                status = self.random.choice(self.error_codes)
+            else:
+                status = None
+
+            if status is not None:
+                self.injected[status] += 1
+
+            return status, headers
+
+    def _delay(self) -> None:
+        delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0.0)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    # Обработчики API: (метод, шаблон пути, имя метода клиента, функция)
+
+    def _routes(self) -> List[Tuple[str, Any, Optional[str], Callable]]:
+        return [
+            ('GET', re.compile(r'/api/v1/instance/?'), None, self._instance_v1),
+            ('GET', re.compile(r'/api/v2/instance/?'), None, self._instance_v2),
+            ('GET', re.compile(r'/api/v1/accounts/verify_credentials'), 'account_verify_credentials', lambda log, **_: self.me),
+            ('GET', re.compile(r'/api/v1/accounts/search'), 'account_search', self._account_search),
+            ('POST', re.compile(r'/api/v1/accounts/(?P<id>[^/]+)/follow'), 'account_follow', self._follow),
+            ('POST', re.compile(r'/api/v1/accounts/(?P<id>[^/]+)/unfollow'), 'account_unfollow', self._unfollow),
+            ('POST', re.compile(r'/api/v1/statuses'), 'status_post', self._status_post),
+            ('POST', re.compile(r'/api/v1/statuses/(?P<id>[^/]+)/favourite'), 'status_favourite', self._favourite),
+            ('GET', re.compile(r'/api/v1/timelines/home'), 'timeline_home', self._timeline_home),
+            ('GET', re.compile(r'/api/v1/notifications'), 'notifications', self._notifications),
+        ]
+
+    def _instance_v1(self, log, **_) -> Dict[str, Any]:
+        host = urlsplit(self.url).netloc
+
+        return {'uri': host, 'title': 'Mastodon bench', 'version': '4.3.0', 'urls': {'streaming_api': f'ws://{host}'}}
+
+    def _instance_v2(self, log, **_) -> Dict[str, Any]:
+        host = urlsplit(self.url).netloc
+        feeds = {'local': 'authenticated', 'remote': 'authenticated'}
+
+        return {
+            'domain': host,
+            'title': 'Mastodon bench',
+            'version': '4.3.0',
+            'configuration': {
+                'urls': {'streaming': f'ws://{host}'},
+                'timelines_access': {'live_feeds': feeds, 'hashtag_feeds': feeds, 'trending_link_feeds': feeds},
+            },
+        }
+
+    def _account_search(self, log, params, **_) -> List[Dict]:
+        nick = params.get('q', '').lstrip('@').split('@')[0]
+
+        return [self.account(nick)] if nick else []
+
+    def _relationship(self, account_id: str, following: bool) -> Dict[str, Any]:
+        return {'id': account_id, 'following': following, 'followed_by': False, 'blocking': False, 'muting': False, 'requested': False}
+
+    def _follow(self, log, id, **_) -> Dict[str, Any]:
+        log.append(AccountFollow(user_id=id))
+        return self._relationship(id, True)
+
+    def _unfollow(self, log, id, **_) -> Dict[str, Any]:
+        log.append(AccountUnfollow(user_id=id))
+        return self._relationship(id, False)
+
+    def _status_post(self, log, params, **_) -> Dict[str, Any]:
+        reply_to = params.get('in_reply_to_id') or None
+        log.append(StatusPost(content=params.get('status', ''), in_reply_to_id=log_id(str(reply_to)) if reply_to else None))
+
+        status = self.make_status(self.nick, params.get('status', ''), in_reply_to_id=reply_to)
+
+        with self._lock:
+            self.statuses[status['id']] = status
+
+        return status
+
+    def _favourite(self, log, id, **_) -> Dict[str, Any]:
+        log.append(StatusFavorite(post_id=log_id(id)))
+
+        with self._lock:
+            status = self.statuses.get(id)
+
+        if status is None:
+            status = self.make_status('unknown', '')
+            status['id'] = id
+
+        return dict(status, favourited=True)
+
+    @staticmethod
+    def _page(items: List[Dict], params: Dict[str, str]) -> List[Dict]:
+        """Страница ленты по min_id/since_id/max_id, от новых к старым."""
+        def key(item):
+            return int(item['id'])
+
+        if params.get('max_id'):
+            items = [i for i in items if key(i) < int(params['max_id'])]
+
+        limit = int(params.get('limit', 20))
+
+        if params.get('min_id'):
+            # min_id отдает ближайшие к курсору события
+            items = sorted((i for i in items if key(i) > int(params['min_id'])), key=key)[:limit]
+            return sorted(items, key=key, reverse=True)
+
+        if params.get('since_id'):
+            items = [i for i in items if key(i) > int(params['since_id'])]
+
+        return sorted(items, key=key, reverse=True)[:limit]
+
+    def _timeline_home(self, log, params, **_) -> List[Dict]:
+        with self._lock:
+            items = list(self.timeline)
+
+        return self._page(items, params)
+
+    def _notifications(self, log, params, **_) -> List[Dict]:
+        with self._lock:
+            items = list(self.notifications)
+
+        types = params.get('types[]')
+        if types:
+            items = [i for i in items if i['type'] in types]
+
+        return self._page(items, params)
+
+    def _stream(self, handler: BaseHTTPRequestHandler) -> None:
+        stream: queue.Queue = queue.Queue()
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        handler.close_connection = True
+
+        with self._stream_cond:
+            self._streams.append(stream)
+            self._stream_cond.notify_all()
+
+        try:
+            handler.wfile.write(b':)\n')
+            handler.wfile.flush()
+
+            while True:
+                try:
+                    message = stream.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    message = b':thump\n'
+
+                if message is None:
+                    return
+
+                handler.wfile.write(message)
+                handler.wfile.flush()
+
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+        finally:
+            with self._lock:
+                self._streams.remove(stream)
+
+    def _handler(self) -> Any:
+        server = self
+        routes = self._routes()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _params(self) -> Dict[str, Any]:
+                url = urlsplit(self.path)
+                params = {k: v if k.endswith('[]') else v[-1] for k, v in parse_qs(url.query).items()}
+
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode('utf-8')
+
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update({k: v if k.endswith('[]') else v[-1] for k, v in parse_qs(body).items()})
+
+                return params
+
+            def _reply(self, status: int, payload: Any, headers: Dict[str, str] = None) -> None:
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _dispatch(self, method: str) -> None:
+                path = urlsplit(self.path).path
+                params = self._params()
+
+                if method == 'GET' and path.rstrip('/') == '/api/v1/streaming/user':
+                    server._stream(self)
+                    return
+
+                for route_method, pattern, name, func in routes:
+                    match = pattern.fullmatch(path)
+
+                    if route_method == method and match:
+                        break
+                else:
+                    self._reply(404, {'error': 'Record not found'})
+                    return
+
+                server._delay()
+
+                if name is None:
+                    self._reply(200, func(None))
+                    return
+
+                case = self.headers.get(CASE_HEADER)
+                error, headers = server._admit()
+
+                with server._lock:
+                    log, calls = server._log(case)
+                    calls[name] += 1
+
+                if error is not None:
+                    message = 'Too many requests' if error == 429 else 'Injected failure'
+                    self._reply(error, {'error': message}, headers)
+                    return
+
+                self._reply(200, func(log, params=params, **match.groupdict()), headers)
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'api_calls': sum(self.api_calls.values()) + sum(sum(c.api_calls.values()) for c in self.memory if isinstance(c, CaseLog)),
+                'injected': dict(self.injected),
+                'streams': len(self._streams),
+                'statuses': len(self.statuses),
+            }
@@ -0,0 +1,86 @@
+"""Скорость перевода HTML статусов в текст: normalize_status против BeautifulSoup.
+
+Статусы собраны в формате API Mastodon: короткие посты, упоминания с хэштегами
+и ссылками (со служебными invisible-спанами), длинные посты в несколько абзацев.
+Кроме времени проверяется, что текст совпадает с get_text() с точностью до пробелов.
+
+Запуск из папки tests: python normalize_bench.py --repeats 2000
+"""
+import sys
+
+sys.path.append('..')
+
+import argparse
+import re
+import time
+from typing import Any, Callable, Dict, List
+from bs4 import BeautifulSoup
+from src.mastodon.normalize import normalize_status
+
+
+def mention(nick: str) -> str:
+    return f'<span class="h-card" translate="no"><a href="https://mastodon.social/@{nick}" class="u-url mention">@<span>{nick}</span></a></span>'
+
+
+def hashtag(tag: str) -> str:
+    return f'<a href="https://mastodon.social/tags/{tag}" class="mention hashtag" rel="tag">#<span>{tag}</span></a>'
+
+
+def link(url: str) -> str:
+    scheme, rest = url.split('://', 1)
+    return (f'<a href="{url}" target="_blank" rel="nofollow noopener noreferrer" translate="no">'
+            f'<span class="invisible">{scheme}://</span><span class="ellipsis">{rest[:30]}</span><span class="invisible">{rest[30:]}</span></a>')
+
+
+def samples() -> List[Dict[str, Any]]:
+    paragraph = 'Сегодня разбирался с тем, как устроены трансформеры, и это оказалось проще, чем я думал &amp; интереснее. '
+
+    return [
+        {'content': '<p>Доброе утро всем!</p>', 'mentions': [], 'tags': []},
+        {'content': f'<p>{mention("tcar")} привет! Что думаешь про {hashtag("ИИ")}? Вот статья: {link("https://example.org/articles/2024/transformers-explained")}</p>',
+         'mentions': [{'username': 'tcar', 'acct': 'tcar'}], 'tags': [{'name': 'ИИ'}]},
+        {'content': f'<p>{mention("alice")} {mention("bob")} согласен &lt;3</p><p>{hashtag("наука")} {hashtag("космос")}</p>',
+         'mentions': [{'username': 'alice', 'acct': 'alice'}, {'username': 'bob', 'acct': 'bob@example.org'}], 'tags': [{'name': 'наука'}, {'name': 'космос'}]},
+        {'content': ''.join(f'<p>{paragraph * 3}<br>{link("https://example.org/long/path/to/some/page?id=%d" % i)}</p>' for i in range(5)),
+         'mentions': [], 'tags': []},
+    ]
+
+
+def measure(func: Callable, statuses: List[Dict[str, Any]], repeats: int) -> float:
+    started = time.perf_counter()
+
+    for _ in range(repeats):
+        for status in statuses:
+            func(status)
+
+    return 1e6 * (time.perf_counter() - started) / (repeats * len(statuses))
+
+
+def squash(text: str) -> str:
+    return re.sub(r'\s+', '', text)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=2000)
+    args = parser.parse_args()
+
+    statuses = samples()
+
+    for status in statuses:
+        normalized = normalize_status(status)
+        assert squash(normalized.text) == squash(BeautifulSoup(status['content'], 'html.parser').get_text()), normalized.text
+
+    soup = measure(lambda s: BeautifulSoup(s['content'], 'html.parser').get_text(), statuses, args.repeats)
+    fast = measure(normalize_status, statuses, args.repeats)
+
+    print(f'BeautifulSoup.get_text: {soup:8.1f} us/статус')
+    print(f'normalize_status:       {fast:8.1f} us/статус (x{soup / fast:.1f})')
+
+    for status in statuses[1:3]:
+        normalized = normalize_status(status)
+        print(f'{normalized.text!r}: упоминания {normalized.mentions}, теги {normalized.tags}, ссылки {normalized.links}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""Подбор порога фильтра релевантности на кейсах бенчмарка.
+
+Для каждого поста из ленты (кейсы типа update) выводится оценка релевантности и
+эталонная реакция агента, а для сетки порогов - сколько постов с эталонным действием
+будет потеряно и сколько пустых обращений к LLM будет сэкономлено.
+
+Запуск из папки tests: python relevance_bench.py
+"""
+import sys
+
+sys.path.append('..')
+
+import json
+from src.mastodon.relevance import RelevanceFilter
+from main import load_config
+
+
+config = load_config('../config/config.yaml')
+
+relevance = RelevanceFilter(config['user_profile']['interests'])
+
+with open('inputs/bench_tests.json', 'r', encoding='utf-8') as f:
+    cases = [c for c in json.load(f) if c['input_signal']['type'] == 'update']
+
+scored = []
+for case in cases:
+    text = case['input_signal']['args']['content']
+    expected = [o['type'] for o in case['outputs']]
+    scored.append((relevance.score(text), bool(expected)))
+
+    print(f'{scored[-1][0]:.2f}  {expected or "-"!s:<20} {text}')
+
+print('\nпорог  пропущено действий  сэкономлено вызовов LLM')
+for threshold in (0.0, 0.25, 0.5, 0.75, 1.0):
+    lost = sum(1 for score, expected in scored if score < threshold and expected)
+    saved = sum(1 for score, expected in scored if score < threshold and not expected)
+
+    print(f'{threshold:<6} {lost:>3} / {sum(e for _, e in scored):<14} {saved:>3} / {sum(not e for _, e in scored)}')
@@ -4,14 +4,35 @@ sys.path.append('..')
 
 from src.models.user_profile import UserProfile
 from src.graph.logic_graph import build_graph
+from src.graph.rules import RuleEngine
+from src.graph.response_cache import ResponseCache
 from tests.mastodon_emulation import MastodonEmulator
+from tests.mastodon_server import MastodonServer
 from tests.bench import MastodonBenchmark
 from langgraph.checkpoint.sqlite import SqliteSaver
 from main import load_config
+from src.llm.replay import ResponseStore, wrap_llm
 from langchain_openai import ChatOpenAI
+import argparse
 import os
 
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--concurrency', type=int, default=4, help='Сколько пользователей прогонять параллельно')
+parser.add_argument('--resume', action='store_true', help='Продолжить прерванный прогон')
+parser.add_argument('--llm-cache', choices=['off', 'record', 'replay'], help='Режим кэша LLM (по умолчанию из секции llm_cache)')
+parser.add_argument('--no-rules', action='store_true', help='Решать все события через LLM, без правил')
+parser.add_argument('--no-response-cache', action='store_true', help='Не использовать кэш реакций на похожие сообщения')
+parser.add_argument('--output', default='results/bench_res', help='Путь результатов без расширения (для сравнения прогонов в compare.py)')
+parser.add_argument('--judge-batch', type=int, default=8, help='Сколько ответов оценивать одним вызовом судьи')
+parser.add_argument('--price', type=float, nargs=2, default=[0.15, 0.6], metavar=('PROMPT', 'COMPLETION'), help='Цена 1M токенов модели агента, USD')
+parser.add_argument('--on-miss', choices=['fail', 'passthrough'], help='Поведение при промахе кэша в режиме replay')
+parser.add_argument('--server', action='store_true', help='Работать через настоящий клиент Mastodon и локальный HTTP-сервер вместо эмулятора')
+parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответов сервера, с (с --server)')
+parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов 5xx (с --server)')
+parser.add_argument('--ratelimit-rate', type=float, default=0.0, help='Доля ответов 429 (с --server)')
+args = parser.parse_args()
+
 config = load_config('../config/config.yaml')
 
 for var, val in config['langsmith'].items():
@@ -21,25 +42,67 @@ profile = UserProfile(
     **config['user_profile']
 )
 
-mastodon = MastodonEmulator()
+if args.server:
+    server = MastodonServer(latency=args.latency, error_rate=args.error_rate, ratelimit_rate=args.ratelimit_rate, nick=profile.nick).start()
+    # Журнал действий ведет сервер, граф работает с настоящим клиентом
+    mastodon, client = server, server.client()
+else:
+    server = None
+    mastodon = client = MastodonEmulator()
+
+cache_config = dict(config.get('llm_cache', {}))
+cache_config['path'] = os.path.join('..', cache_config.get('path', 'data/llm_cache.sqlite'))
+
+if args.llm_cache:
+    cache_config['mode'] = args.llm_cache
+
+if args.on_miss:
+    cache_config['on_miss'] = args.on_miss
+
+# Агент и судья пишут ответы в одно хранилище
+store = ResponseStore(cache_config['path']) if cache_config.get('mode', 'off') != 'off' else None
+llm = wrap_llm(ChatOpenAI(**config['llm']), cache_config, store)
 
-if os.path.exists('../data/test.sqlite'):
+# При продолжении прогона память агента должна сохраниться
+if os.path.exists('../data/test.sqlite') and not args.resume:
     os.remove('../data/test.sqlite')
 
+rules = None if args.no_rules else RuleEngine.from_config(config.get('rules'), profile.interests)
+response_cache = None if args.no_response_cache else ResponseCache.from_config(config.get('response_cache'))
+
 with SqliteSaver.from_conn_string('../data/test.sqlite') as memory:
     graph = build_graph(
         profile=profile,
-        mastodon=mastodon,
+        mastodon=client,
         checkpointer=memory,
-        llm_config=config['llm']
+        llm_config=config['llm'],
+        graph_config=config.get('graph'),
+        memory_config=config.get('memory'),
+        llm=llm,
+        rules=rules,
+        response_cache=response_cache
     )
 
-    c = config['llm']
+    c = dict(config['llm'])
     c['model'] = 'gpt-4o'
 
-    judge = ChatOpenAI(**c)
+    judge = wrap_llm(ChatOpenAI(**c), cache_config, store)
 
-    benchmark = MastodonBenchmark(graph, profile, mastodon, judge)
+    benchmark = MastodonBenchmark(graph, profile, mastodon, judge, judge_batch_size=args.judge_batch,
+                                  prices={'prompt': args.price[0], 'completion': args.price[1]})
     benchmark.load_bench('inputs/bench_tests.json')
 
-    benchmark.run()
+    benchmark.run(concurrency=args.concurrency, resume=args.resume, results_path=args.output)
+
+    if rules is not None:
+        print(f'Правила: {rules.snapshot()}')
+
+    if response_cache is not None:
+        print(f'Кэш реакций: {response_cache.snapshot()}')
+
+    if store is not None:
+        print(f'Кэш LLM агента: {llm.snapshot()}, судьи: {judge.snapshot()}')
+
+    if server is not None:
+        print(f'Сервер Mastodon: {server.snapshot()}')
+        server.stop()
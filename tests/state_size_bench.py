@@ -0,0 +1,81 @@
+"""Сравнение размера и времени сериализации чекпоинта в старом и компактном формате состояния.
+
+Старый формат: в состоянии объект UserProfile, история - словари {'role', 'content'}
+с системным промптом персоны первым сообщением. Компактный: ник профиля (profile_id)
+и история парами [код роли, текст].
+
+Запуск из папки tests: python state_size_bench.py --lengths 10 50 200
+"""
+import sys
+
+sys.path.append('..')
+
+import argparse
+import time
+from typing import Any, Dict, List
+from langgraph.checkpoint.sqlite import SqliteSaver
+from src.memory.compact import encode_history
+from src.models.user_profile import UserProfile
+
+
+def make_history(length: int) -> List[Dict[str, str]]:
+    history = []
+
+    for i in range(length // 2):
+        history.append({'role': 'user', 'content': f'Пользователь user{i % 7} написал пост: ' + 'пост ' * 30})
+        history.append({'role': 'system', 'content': 'Ты ответил пользователю: ' + 'ответ ' * 15})
+
+    return history
+
+
+def legacy_state(profile: UserProfile, length: int) -> Dict[str, Any]:
+    persona = {'role': 'system', 'content': f'Тебя зовут {profile.nick}. Твои интересы: {", ".join(profile.interests)}. Стиль: {profile.style}'}
+
+    return {'profile': profile, 'chat_history': [persona] + make_history(length)}
+
+
+def compact_state(profile: UserProfile, length: int) -> Dict[str, Any]:
+    return {'profile_id': profile.nick, 'chat_history': encode_history(make_history(length))}
+
+
+def measure(serde: Any, values: Dict[str, Any], repeats: int) -> Dict[str, float]:
+    # Каналы сохраняются по отдельности, как в чекпоинте SqliteSaver
+    size = sum(len(serde.dumps_typed(value)[1]) for value in values.values())
+
+    started = time.perf_counter()
+    for _ in range(repeats):
+        dumped = [serde.dumps_typed(value) for value in values.values()]
+    dumps = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for typed in dumped:
+            serde.loads_typed(typed)
+    loads = time.perf_counter() - started
+
+    return {'bytes': size, 'dumps_us': 1e6 * dumps / repeats, 'loads_us': 1e6 * loads / repeats}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--repeats', type=int, default=500)
+    args = parser.parse_args()
+
+    serde = SqliteSaver(None).serde
+    profile = UserProfile(interests=['ИИ', 'программирование', 'наука'], style='дружелюбный и краткий', nick='tcar')
+
+    print(f'{"история":<10} {"формат":<10} {"байт":>10} {"dumps":>12} {"loads":>12}')
+
+    for length in args.lengths:
+        legacy = measure(serde, legacy_state(profile, length), args.repeats)
+        compact = measure(serde, compact_state(profile, length), args.repeats)
+
+        for label, result in (('старый', legacy), ('компактный', compact)):
+            print(f'{length:<10} {label:<10} {result["bytes"]:>10} {result["dumps_us"]:>9.1f} us {result["loads_us"]:>9.1f} us')
+
+        print(f'{"":<10} {"экономия":<10} {1 - compact["bytes"] / legacy["bytes"]:>10.1%}')
+
+
+if __name__ == '__main__':
+    main()